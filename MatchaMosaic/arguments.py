@@ -0,0 +1,45 @@
+"""
+Command-line options shared by the entry points (cli, batch, server, sequence and striped): the tiles library, the
+operators of the coordinator and the grid of the mosaic.
+"""
+import argparse
+import os
+import sys
+
+from coordinates import COLOR_SPACE_RGB, DEFAULT_OPERATORS, Coordinator, build_coordinator
+from mosaic import DEFAULT_GRID_SHAPE
+from tiles import DEFAULT_USE_CACHE, DEFAULT_WORKERS, TileFactory, TileLibrary
+from utilities import parse_grid
+
+
+def add_library_arguments(parser: argparse.ArgumentParser, grid_help: str = "rows and columns, e.g. 42x57") -> None:
+    """
+    Adds the options describing the tiles library, the operators and the grid.
+    :param parser: The parser of the entry point
+    :param grid_help: The description of the grid option
+    """
+    parser.add_argument("--tiles", required=True, help="path of the CSV file describing the tiles")
+    parser.add_argument("--tiles-folder", help="folder of the tiles images; the folder of the CSV file by default")
+    parser.add_argument("--grid", type=parse_grid, default=DEFAULT_GRID_SHAPE, help=grid_help)
+    parser.add_argument("--operators", nargs="+", type=parse_grid, default=DEFAULT_OPERATORS,
+                        help="grids of the average samplers, e.g. 1x1 2x2")
+
+
+def load_library(args: argparse.Namespace, color_space: str = COLOR_SPACE_RGB, use_cache: bool = DEFAULT_USE_CACHE,
+                 workers: int = DEFAULT_WORKERS) -> (Coordinator, TileLibrary):
+    """
+    Builds the coordinator and ingests the tiles library described by the options (see add_library_arguments).
+    The tiles that can't be loaded are reported on the standard error.
+    :param args: The parsed options
+    :param color_space: The color space of the samplers
+    :param use_cache: Whether the features cache is used
+    :param workers: The number of processes loading the tiles images
+    :return: The coordinator and the library
+    """
+    coordinator = build_coordinator(args.operators, color_space=color_space)
+    tiles_folder = args.tiles_folder if args.tiles_folder is not None else os.path.dirname(args.tiles)
+    factory = TileFactory(coordinator, use_cache=use_cache, workers=workers)
+    library = factory.create_from_file(args.tiles, tiles_folder)
+    for (path, error) in factory.failures:
+        print(f"Skipped tile <{path}>: {error}", file=sys.stderr)
+    return coordinator, library
@@ -0,0 +1,281 @@
+import heapq
+from collections import deque
+
+import numpy as np
+
+from cells import DEFAULT_CELL_CANDIDATES, Cell, CellGrid
+from distances import candidate_tiles
+from instrumentation import INSTRUMENTATION
+from metrics import Metric
+
+DEFAULT_CANDIDATES = 16
+DEFAULT_TOLERANCE = 1e-3
+DEFAULT_SCALING_FACTOR = 4.0
+DEFAULT_PHASES = 3
+# Lower bound of the distances used as scales, to avoid degenerate increments
+ZERO_DISTANCE = 1e-6
+# Holders of the copies of the tiles during the auction
+UNASSIGNED = -1
+DUMMY = -2
+
+
+class GreedyScheduler:
+    """
+    Priority queue of the cells still waiting for a tile.
+    Every cell is keyed by the distance to its nearest available tile, so that the fittest cell can be extracted
+    without sorting all the remaining cells again at every step.
+    The keys are updated lazily: when a tile runs out, the cells pointing to it are not touched until they reach the
+    top of the queue. Since the distance of a cell can only grow when tiles become unavailable, a stale key is always
+    a lower bound of the real one, and re-checking the top entry is enough to keep the greedy order.
+    """
+
+    def __init__(self, cells: [Cell]):
+        """
+        Creates the queue from the cells to assign.
+        :param cells: The unassigned cells; their order is used to break ties between equal distances
+        """
+        # The index is unique, so the cells themselves are never compared
+        self.__heap = [(cell.get_nearest_distance(), index, cell) for (index, cell) in enumerate(cells)]
+        heapq.heapify(self.__heap)
+
+    def __len__(self) -> int:
+        return len(self.__heap)
+
+    def pop_fittest(self) -> Cell:
+        """
+        Extracts the cell with the minimum distance to its nearest available tile.
+        Entries whose tile has become unavailable are re-inserted with their updated distance.
+        :return: The fittest cell
+        """
+        while self.__heap:
+            (distance, index, cell) = heapq.heappop(self.__heap)
+            (_, current_distance) = cell.get_nearest_available_tile_pair()
+            # The key is still valid: the nearest tile has not changed
+            if current_distance <= distance:
+                return cell
+            # The nearest tile ran out: the cell is queued again with its new distance
+            INSTRUMENTATION.count("cells_requeued")
+            heapq.heappush(self.__heap, (current_distance, index, cell))
+        raise Exception("No cell left to assign")
+
+
+def assign_greedily(cells_coords: np.ndarray, library, candidates: int = DEFAULT_CELL_CANDIDATES,
+                    metric: Metric = None) -> np.ndarray:
+    """
+    Assigns the tiles of a library to a set of cells with the greedy strategy, consuming their quantities.
+    It's the same assignment of a mosaic, for the cells known only by their coordinates.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param library: The TileLibrary; its quantities are decreased by the assigned tiles
+    :param candidates: The number of nearest tiles kept for every cell (see CellGrid)
+    :param metric: The distance between the coordinates; the euclidean one if not given
+    :return: The index of the tile assigned to every cell
+    """
+    (candidates, distances) = candidate_tiles(cells_coords, library.coords, candidates, metric=metric)
+    # The cells form a single column: the index of a cell is its row in the matrix
+    cells = CellGrid((len(cells_coords), 1), cells_coords, library, candidates, distances, metric=metric)
+    scheduler = GreedyScheduler(cells)
+    while len(scheduler) > 0:
+        scheduler.pop_fittest().assign_tile()
+    return cells.assigned.astype(np.intp)
+
+
+class AuctionSolver:
+    """
+    Optimal assignment of the cells to tiles with limited quantities.
+    The problem is a transportation problem: every tile offers its quantity, every cell demands one tile, and the
+    total distance has to be minimized. It's solved with the auction algorithm, where every copy of a tile has a
+    price and the unassigned cells bid for the copy giving them the best trade-off between distance and price. The
+    prices are refined with epsilon-scaling, and the final assignment is optimal within the given tolerance.
+    The copies exceeding the number of cells are taken by "dummy" bidders, which are indifferent to the tiles: this
+    makes the problem symmetric, so that the prices can be carried from a phase to the next one.
+    To scale with large libraries, every cell only considers its k nearest tiles. An extra "overflow" option, more
+    expensive than any real tile, keeps the problem solvable; if some cell ends up using it, the candidates weren't
+    enough and the problem is solved again with twice as many candidates.
+    """
+
+    def __init__(self, candidates: int = DEFAULT_CANDIDATES, tolerance: float = DEFAULT_TOLERANCE,
+                 scaling_factor: float = DEFAULT_SCALING_FACTOR, phases: int = DEFAULT_PHASES):
+        """
+        Constructor.
+        :param candidates: The number of nearest tiles considered by every cell
+        :param tolerance: The relative optimality gap: the total distance exceeds the optimal one (among the
+        candidates) by less than this fraction of the sum of the distances of every cell from its nearest tile
+        :param scaling_factor: The factor reducing the bidding increment between two phases
+        :param phases: The number of phases, each one with a smaller increment than the previous one
+        """
+        if candidates < 1:
+            raise Exception(f"Illegal number of candidates: {candidates}. Please use a positive value.")
+        if tolerance <= 0:
+            raise Exception(f"Illegal tolerance: {tolerance}. Please use a positive value.")
+        if scaling_factor <= 1:
+            raise Exception(f"Illegal scaling factor: {scaling_factor}. Please use a value greater than 1.")
+        if phases < 1:
+            raise Exception(f"Illegal number of phases: {phases}. Please use a positive value.")
+        self.__candidates = candidates
+        self.__tolerance = tolerance
+        self.__scaling_factor = scaling_factor
+        self.__phases = phases
+
+    @property
+    def candidates(self) -> int:
+        return self.__candidates
+
+    def solve(self, cells_coords: np.ndarray, tiles_coords: np.ndarray, quantities: np.ndarray,
+              metric: Metric = None, matcher=None,
+              candidate_graph: (np.ndarray, np.ndarray) = None) -> (np.ndarray, float):
+        """
+        Assigns a tile to every cell.
+        The assignment is optimal (within the tolerance) only among the candidates of every cell: the search for more
+        candidates is triggered when some cell can't be seated, not when a tile outside of the candidates would lower
+        the total. With very few candidates (e.g. 1 or 2) the total can exceed the optimum of the full graph by a few
+        percent; with the default number the difference is usually within the tolerance, and with as many candidates
+        as tiles the assignment is optimal.
+        :param cells_coords: The (C, d) matrix of the cells coordinates
+        :param tiles_coords: The (T, d) matrix of the tiles coordinates
+        :param quantities: The available quantity of every tile
+        :param metric: The distance between the coordinates; the euclidean one if not given
+        :param matcher: An optional coarse-to-fine matcher (see pruning.CoarseToFineMatcher) finding the candidates
+        :param candidate_graph: The nearest tiles of every cell, ordered by increasing distance, and their distances,
+        when they've already been found; they're used as the first candidates graph if they're enough
+        :return: The index of the tile assigned to every cell, and the total distance of the assignment
+        """
+        quantities = np.asarray(quantities, dtype=np.int64)
+        (n_cells, n_tiles) = (cells_coords.shape[0], tiles_coords.shape[0])
+        if quantities.sum() < n_cells:
+            raise Exception(f"Not enough tiles: {quantities.sum()} available for {n_cells} cells")
+        k = min(self.__candidates, n_tiles)
+        search = matcher.candidate_tiles if matcher is not None else candidate_tiles
+        while True:
+            if candidate_graph is not None and candidate_graph[0].shape[1] >= k:
+                (candidates, distances) = (candidate_graph[0][:, :k], candidate_graph[1][:, :k])
+            else:
+                (candidates, distances) = search(cells_coords, tiles_coords, k, metric=metric)
+            # The graph given by the caller is only used for the first attempt
+            candidate_graph = None
+            INSTRUMENTATION.count("auction_candidate_graphs")
+            (assignment, total) = self.__auction(candidates, distances.astype(np.float64), quantities)
+            if assignment is not None:
+                return assignment, total
+            # Some cell couldn't find room among its candidates
+            k = min(2 * k, n_tiles)
+
+    def __auction(self, candidates: np.ndarray, distances: np.ndarray, quantities: np.ndarray) -> (np.ndarray, float):
+        """
+        Runs the auction on the candidates graph.
+        :return: The assigned tiles and the total distance, or None if the overflow option has been used
+        """
+        (n_cells, k) = candidates.shape
+        n_tiles = len(quantities)
+        span = max(float(distances.max() - distances.min()), ZERO_DISTANCE)
+        # The overflow option is the last type, with enough copies for every cell
+        overflow = n_tiles
+        types = np.hstack([candidates, np.full(shape=(n_cells, 1), fill_value=overflow)])
+        costs = np.hstack([distances, distances[:, -1:] + 2 * span])
+        capacities = np.append(quantities, n_cells)
+        # Every copy of a tile is a slot with its own price; the slots of a type are kept in a heap by price
+        slot_type = np.repeat(np.arange(n_tiles + 1), capacities)
+        n_slots = len(slot_type)
+        n_dummies = n_slots - n_cells
+        prices = np.zeros(shape=n_slots)
+        holder = np.empty(shape=n_slots, dtype=np.intp)
+        assigned = np.empty(shape=n_cells, dtype=np.intp)
+
+        # The error of the result is bounded by epsilon times the number of bidders
+        final_epsilon = self.__tolerance * max(float(distances[:, 0].mean()), ZERO_DISTANCE) * n_cells / n_slots
+        epsilon = final_epsilon * self.__scaling_factor ** (self.__phases - 1)
+        while True:
+            # Every phase starts with all the bidders unassigned, keeping the prices of the previous one
+            heaps = [[] for _ in range(n_tiles + 1)]
+            for slot in range(n_slots):
+                heaps[slot_type[slot]].append((prices[slot], slot))
+            for heap in heaps:
+                heapq.heapify(heap)
+            cheapest = np.array([heap[0][0] for heap in heaps])
+            # Heap of the types by cheapest slot, used by the dummies; it's updated lazily
+            market = [(price, t) for (t, price) in enumerate(cheapest)]
+            heapq.heapify(market)
+            holder[:] = UNASSIGNED
+            assigned[:] = UNASSIGNED
+            queue = deque(range(n_cells))
+            # The dummies can take the copies within epsilon from the lowest price right away, without bidding
+            order = np.argsort(prices, kind="stable")
+            seated = order[:np.searchsorted(prices[order], prices[order[0]] + epsilon, side="right")][:n_dummies]
+            holder[seated] = DUMMY
+            dummies = n_dummies - len(seated)
+            while queue or dummies:
+                if queue:
+                    c = queue.popleft()
+                    (t, bid) = self.__cell_bid(costs[c], types[c], cheapest, heaps, epsilon)
+                else:
+                    c = DUMMY
+                    dummies -= 1
+                    (t, bid) = self.__dummy_bid(market, cheapest, heaps, epsilon)
+                # The cheapest copy goes to the bidder, at the new price
+                heap = heaps[t]
+                slot = heap[0][1]
+                heapq.heapreplace(heap, (bid, slot))
+                prices[slot] = bid
+                cheapest[t] = heap[0][0]
+                heapq.heappush(market, (cheapest[t], t))
+                previous = holder[slot]
+                if previous == DUMMY:
+                    dummies += 1
+                elif previous != UNASSIGNED:
+                    assigned[previous] = UNASSIGNED
+                    queue.append(previous)
+                holder[slot] = c
+                if c != DUMMY:
+                    assigned[c] = slot
+                INSTRUMENTATION.count("auction_bids")
+            if epsilon <= final_epsilon:
+                break
+            epsilon = max(epsilon / self.__scaling_factor, final_epsilon)
+
+        assigned_types = slot_type[assigned]
+        if np.any(assigned_types == overflow):
+            return None, None
+        # Reading the distance of every cell from the chosen candidate
+        chosen = np.argmax(types == assigned_types[:, np.newaxis], axis=1)
+        total = float(distances[np.arange(n_cells), chosen].sum())
+        return assigned_types, total
+
+    @staticmethod
+    def __cell_bid(costs: np.ndarray, types: np.ndarray, cheapest: np.ndarray, heaps: [list],
+                   epsilon: float) -> (int, float):
+        """
+        Computes the bid of a cell: the type it wants and the new price of its cheapest copy.
+        The price is raised until the cell would be indifferent between that copy and its second best option.
+        """
+        values = costs + cheapest[types]
+        j = int(np.argmin(values))
+        (t, best) = (types[j], values[j])
+        heap = heaps[t]
+        # The second best option is another type, or the second cheapest copy of the same one
+        values[j] = np.inf
+        second = values.min()
+        if len(heap) > 1:
+            second = min(second, costs[j] + AuctionSolver.__second_price(heap))
+        return t, cheapest[t] + (second - best) + epsilon
+
+    @staticmethod
+    def __dummy_bid(market: list, cheapest: np.ndarray, heaps: [list], epsilon: float) -> (int, float):
+        """
+        Computes the bid of a dummy, which only looks at the prices: it wants the cheapest copy of all.
+        """
+        # Dropping the stale entries of the market
+        while market[0][0] != cheapest[market[0][1]]:
+            heapq.heappop(market)
+        (best, t) = heapq.heappop(market)
+        while market and market[0][0] != cheapest[market[0][1]]:
+            heapq.heappop(market)
+        second = market[0][0] if market else np.inf
+        heapq.heappush(market, (best, t))
+        if len(heaps[t]) > 1:
+            second = min(second, AuctionSolver.__second_price(heaps[t]))
+        if not np.isfinite(second):
+            second = best
+        return t, second + epsilon
+
+    @staticmethod
+    def __second_price(heap: list) -> float:
+        return min(heap[1][0], heap[2][0]) if len(heap) > 2 else heap[1][0]
@@ -0,0 +1,191 @@
+"""
+Batch mode: many target images composed with the same tiles library.
+The library is ingested once, then the targets are spread across a pool of worker processes. The coordinates of the
+tiles are placed in shared memory, where every worker attaches to them read-only when it starts, and every worker keeps
+its own cache of the loaded and resized tile images for all the targets it processes. The mosaics are written straight
+to disk, and the timings of every target are collected in a JSON summary.
+
+Usage:
+    python batch.py --tiles tiles/tiles_info.csv --targets image/ --output out/
+    python batch.py --tiles tiles/tiles_info.csv --targets a.jpg b.jpg --output out/ --grid 42x57 --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from arguments import add_library_arguments, load_library
+from coordinates import Coordinator
+from mosaic import Mosaic, DEFAULT_GRID_SHAPE, DEFAULT_REINSERTION, DEFAULT_SOLVER, SOLVER_GREEDY, SOLVER_OPTIMAL
+from rendering import TileRenderCache
+from tiles import TileLibrary
+from utilities import list_targets, save_image
+
+DEFAULT_OUTPUT_EXTENSION = ".png"
+SUMMARY_FILE_NAME = "summary.json"
+DEFAULT_BATCH_WORKERS = 1
+
+# State of a worker process, set once when the process starts
+_worker = {}
+
+
+def output_path(target: str, output_folder: str, extension: str = DEFAULT_OUTPUT_EXTENSION) -> str:
+    (name, _) = os.path.splitext(os.path.basename(target))
+    return os.path.join(output_folder, name + extension)
+
+
+def share_library(library: TileLibrary) -> (shared_memory.SharedMemory, dict):
+    """
+    Copies the coordinates of a library to shared memory, so that the worker processes attach to them instead of
+    receiving their own copy. Only the names, the quantities and the image handles are sent to every worker.
+    :param library: The tiles library
+    :return: The shared segment, which the caller closes and unlinks once the workers are done, and the description
+    of the library to send to the workers
+    """
+    coords = library.coords
+    segment = shared_memory.SharedMemory(create=True, size=max(coords.nbytes, 1))
+    np.ndarray(shape=coords.shape, dtype=coords.dtype, buffer=segment.buf)[:] = coords
+    shared = {
+        "coords": (segment.name, coords.shape, coords.dtype),
+        "names": library.names,
+        "quantities": library.quantities,
+        "images": [library.get_image_handle(i) for i in range(len(library))],
+    }
+    return segment, shared
+
+
+def _attach_library(shared: dict) -> (shared_memory.SharedMemory, TileLibrary):
+    """
+    Rebuilds a library in a worker process, over the coordinates in shared memory.
+    """
+    (name, shape, dtype) = shared["coords"]
+    segment = shared_memory.SharedMemory(name=name)
+    coords = np.ndarray(shape=shape, dtype=dtype, buffer=segment.buf)
+    # The coordinates are only read: every mosaic works on its own copy of the quantities
+    coords.flags.writeable = False
+    return segment, TileLibrary(shared["names"], coords, shared["quantities"], shared["images"])
+
+
+def init_worker(coordinator: Coordinator, library, options: dict) -> None:
+    """
+    Initializes the state of a worker, shared by all the targets it processes.
+    :param library: The tiles library, or its description when its coordinates are in shared memory (see
+    share_library)
+    """
+    if isinstance(library, dict):
+        # The segment stays attached as long as the worker lives
+        (_worker["segment"], library) = _attach_library(library)
+    _worker["coordinator"] = coordinator
+    _worker["library"] = library
+    _worker["options"] = options
+    _worker["render_cache"] = TileRenderCache()
+
+
+def compose_target(target: str, output: str, options: dict = None) -> dict:
+    """
+    Composes the mosaic of a target and writes it to disk, using the state of the current worker.
+    Every mosaic uses its own copy of the quantities, so that the targets don't consume each other's tiles.
+    :param options: The grid, reinsertion and solver of this target; the ones of the worker if not given
+    :return: The timings of the target, in seconds, or the error that stopped it
+    """
+    options = options if options is not None else _worker["options"]
+    timings = {}
+    start = time.perf_counter()
+    try:
+        mosaic = Mosaic(target, _worker["coordinator"], _worker["library"].copy(), grid=options["grid"],
+                        reinsertion=options["reinsertion"], render_cache=_worker["render_cache"],
+                        solver=options["solver"])
+        timings["mosaic"] = time.perf_counter() - start
+        mark = time.perf_counter()
+        mosaic.assign_tiles()
+        timings["assign_tiles"] = time.perf_counter() - mark
+        mark = time.perf_counter()
+        image = mosaic.render()
+        timings["render"] = time.perf_counter() - mark
+        mark = time.perf_counter()
+        save_image(output, image)
+        timings["write"] = time.perf_counter() - mark
+    except Exception as e:
+        return {"target": target, "output": None, "error": str(e)}
+    timings["total"] = time.perf_counter() - start
+    return {"target": target, "output": output, "seconds": timings}
+
+
+def run_batch(targets: [str], coordinator: Coordinator, library: TileLibrary, output_folder: str,
+              grid: (int, int) = DEFAULT_GRID_SHAPE, reinsertion: bool = DEFAULT_REINSERTION,
+              solver: str = DEFAULT_SOLVER, workers: int = DEFAULT_BATCH_WORKERS,
+              extension: str = DEFAULT_OUTPUT_EXTENSION) -> dict:
+    """
+    Composes the mosaic of every target with the same tiles library.
+    A target that fails doesn't stop the batch: its error is reported in the summary.
+    :param targets: The paths of the target images
+    :param coordinator: The coordinator used to compute the coordinates of the cells
+    :param library: The tiles library, already ingested
+    :param output_folder: The folder where the mosaics and the summary are written
+    :param grid: The number of rows and columns of cells of every mosaic
+    :param reinsertion: Whether the tiles can be used without limits
+    :param solver: The assignment strategy (see Mosaic)
+    :param workers: The number of worker processes; 1 means that everything runs in the calling process
+    :param extension: The extension of the written images, which selects their format
+    :return: The summary, which is also written to the output folder
+    """
+    if workers is None or workers < 1:
+        raise Exception(f"Illegal number of workers: {workers}. Please use a positive value.")
+    os.makedirs(output_folder, exist_ok=True)
+    outputs = [output_path(target, output_folder, extension) for target in targets]
+    if len(set(outputs)) != len(outputs):
+        raise Exception("Some targets have the same name: their mosaics would overwrite each other")
+    options = {"grid": grid, "reinsertion": reinsertion, "solver": solver}
+
+    start = time.perf_counter()
+    if workers == 1 or len(targets) <= 1:
+        init_worker(coordinator, library, options)
+        results = [compose_target(target, output) for (target, output) in zip(targets, outputs)]
+        _worker.clear()
+    else:
+        (segment, shared) = share_library(library)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(coordinator, shared, options)) as executor:
+                results = list(executor.map(compose_target, targets, outputs))
+        finally:
+            segment.close()
+            segment.unlink()
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "grid": list(grid),
+        "reinsertion": reinsertion,
+        "solver": solver,
+        "workers": workers,
+        "tiles": len(library),
+        "seconds": elapsed,
+        "completed": sum(1 for r in results if r["output"] is not None),
+        "failed": sum(1 for r in results if r["output"] is None),
+        "targets": results,
+    }
+    with open(os.path.join(output_folder, SUMMARY_FILE_NAME), mode='w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Composes the mosaics of many targets with the same tiles")
+    add_library_arguments(parser)
+    parser.add_argument("--targets", required=True, nargs="+", help="target images, or folders containing them")
+    parser.add_argument("--output", required=True, help="folder where the mosaics are written")
+    parser.add_argument("--reinsertion", action="store_true", help="use the tiles without limits")
+    parser.add_argument("--solver", choices=[SOLVER_GREEDY, SOLVER_OPTIMAL], default=DEFAULT_SOLVER)
+    parser.add_argument("--workers", type=int, default=DEFAULT_BATCH_WORKERS, help="number of worker processes")
+    parser.add_argument("--format", default=DEFAULT_OUTPUT_EXTENSION, help="extension of the written images")
+    args = parser.parse_args()
+
+    (coor, tiles) = load_library(args)
+    report = run_batch(list_targets(args.targets), coor, tiles, args.output, grid=args.grid,
+                       reinsertion=args.reinsertion, solver=args.solver, workers=args.workers, extension=args.format)
+    print(f"{report['completed']} mosaics written to <{args.output}> in {report['seconds']:.3f}s, "
+          f"{report['failed']} failed")
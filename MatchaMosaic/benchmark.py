@@ -0,0 +1,260 @@
+"""
+Benchmark suite for the mosaic pipeline.
+Synthetic targets and tiles libraries are generated on the fly, then every combination of grid size, tiles count,
+operators stack and reinsertion mode is run, timing each stage separately. The results are written to a JSON report,
+which can be compared against the report of another version to catch regressions.
+
+Usage:
+    python benchmark.py --output report.json
+    python benchmark.py --full --output report.json --compare baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from coordinates import build_coordinator
+from instrumentation import INSTRUMENTATION
+from mosaic import Mosaic
+from tiles import TileFactory, MARGIN_TOP, MARGIN_BOTTOM, MARGIN_LEFT, MARGIN_RIGHT, CSV_COL_NAME, \
+    CSV_COL_FILENAME, CSV_COL_QUANTITY
+from utilities import parse_grid
+
+REPORT_VERSION = 1
+
+QUICK_GRIDS = [(10, 10), (50, 50), (100, 100)]
+FULL_GRIDS = [(10, 10), (50, 50), (100, 100), (200, 200), (500, 500)]
+QUICK_TILES_COUNTS = [11, 100]
+FULL_TILES_COUNTS = [11, 100, 1000]
+OPERATOR_STACKS = {
+    "1x1": [(1, 1)],
+    "1x1+2x2": [(1, 1), (2, 2)],
+    "1x1+4x4": [(1, 1), (4, 4)],
+}
+QUICK_OPERATOR_STACKS = ["1x1+2x2"]
+REINSERTION_MODES = [True, False]
+
+STAGES = ["tile_ingestion", "target_featurization", "cell_construction", "assign_tiles", "get_preview"]
+# Name of every stage in the instrumentation
+STAGE_NAMES = {
+    "tile_ingestion": "tile_ingestion",
+    "target_featurization": "target_featurization",
+    "cell_construction": "cell_construction",
+    "assign_tiles": "assign_tiles",
+    "get_preview": "render",
+}
+
+DEFAULT_TILE_SIDE = 64
+DEFAULT_CELL_SIDE = 8
+DEFAULT_MAX_PAIRS = 50_000_000
+DEFAULT_REPEATS = 1
+DEFAULT_TOLERANCE = 0.25
+# Slowdowns smaller than this, in seconds, are timing noise and never count as regressions
+DEFAULT_MIN_SECONDS = 0.01
+# Spare quantity of the synthetic tiles when the reinsertion is not used
+QUANTITY_SLACK = 1.2
+
+
+def synthetic_image(rng: np.random.Generator, height: int, width: int) -> np.ndarray:
+    """
+    Generates an image with smooth color gradients and some noise, resembling a natural photo more than pure noise.
+    :param rng: The random generator
+    :param height: The height of the image
+    :param width: The width of the image
+    :return: The RGB image, as a numpy array of <uint8>
+    """
+    corners = rng.uniform(0, 255, size=(2, 2, 3))
+    v = np.linspace(0, 1, height)[:, None, None]
+    h = np.linspace(0, 1, width)[None, :, None]
+    img = (corners[0, 0] * (1 - v) * (1 - h) + corners[0, 1] * (1 - v) * h +
+           corners[1, 0] * v * (1 - h) + corners[1, 1] * v * h)
+    img += rng.normal(0, 12, size=img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def write_synthetic_library(folder: str, tiles_count: int, quantity: int, seed: int,
+                            tile_side: int = DEFAULT_TILE_SIDE) -> str:
+    """
+    Writes a library of synthetic tiles, as PNG images plus the CSV file describing them.
+    The images include the margins that are cropped when the tiles are loaded.
+    :param folder: The folder where the files are written
+    :param tiles_count: The number of tiles
+    :param quantity: The quantity of every tile
+    :param seed: The seed of the random generator
+    :param tile_side: The side of the useful part of every tile
+    :return: The path of the CSV file
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    height = tile_side + MARGIN_TOP + MARGIN_BOTTOM
+    width = tile_side + MARGIN_LEFT + MARGIN_RIGHT
+    tiles_info = os.path.join(folder, "tiles_info.csv")
+    with open(tiles_info, mode='w') as csv_file:
+        csv_file.write(f"{CSV_COL_NAME},{CSV_COL_FILENAME},{CSV_COL_QUANTITY}\n")
+        for i in range(tiles_count):
+            filename = f"tile_{i:06d}.png"
+            cv2.imwrite(os.path.join(folder, filename), synthetic_image(rng, height, width))
+            csv_file.write(f"tile{i},{filename},{quantity}\n")
+    return tiles_info
+
+
+def run_case(workdir: str, grid: (int, int), tiles_count: int, stack_name: str, reinsertion: bool, seed: int,
+             cell_side: int = DEFAULT_CELL_SIDE) -> dict:
+    """
+    Runs the whole pipeline once, timing every stage through the instrumentation.
+    :return: The timings of the stages, in seconds, plus the counters of the run
+    """
+    cells = grid[0] * grid[1]
+    quantity = 1 if reinsertion else math.ceil(cells * QUANTITY_SLACK / tiles_count)
+    library_folder = os.path.join(workdir, f"tiles_{tiles_count}_{quantity}")
+    tiles_info = os.path.join(library_folder, "tiles_info.csv")
+    if not os.path.exists(tiles_info):
+        write_synthetic_library(library_folder, tiles_count, quantity, seed)
+
+    target_path = os.path.join(workdir, f"target_{grid[0]}x{grid[1]}.png")
+    if not os.path.exists(target_path):
+        target = synthetic_image(np.random.default_rng(seed + 1), grid[0] * cell_side, grid[1] * cell_side)
+        cv2.imwrite(target_path, target)
+
+    coordinator = build_coordinator(OPERATOR_STACKS[stack_name])
+    was_enabled = INSTRUMENTATION.enabled
+    INSTRUMENTATION.enable()
+    INSTRUMENTATION.reset()
+    try:
+        # The output of the pipeline is not interesting here
+        with contextlib.redirect_stdout(io.StringIO()):
+            tiles = TileFactory(coordinator, use_cache=False).create_from_file(tiles_info, library_folder)
+            mosaic = Mosaic(target_path, coordinator, tiles, grid=grid, reinsertion=reinsertion)
+            mosaic.assign_tiles()
+            mosaic.get_preview()
+        timings = {stage: INSTRUMENTATION.get_stage_seconds(STAGE_NAMES[stage]) for stage in STAGES}
+        timings["counters"] = INSTRUMENTATION.snapshot()["counters"]
+    finally:
+        if not was_enabled:
+            INSTRUMENTATION.disable()
+    return timings
+
+
+def case_key(case: dict) -> str:
+    return f"{case['grid'][0]}x{case['grid'][1]}|{case['tiles']}|{case['operators']}|{case['reinsertion']}"
+
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run_suite(grids: [(int, int)], tiles_counts: [int], stacks: [str], reinsertion_modes: [bool],
+              repeats: int = DEFAULT_REPEATS, max_pairs: int = DEFAULT_MAX_PAIRS, seed: int = 0) -> dict:
+    """
+    Runs every combination of the parameters.
+    Cases whose number of cell-tile pairs exceeds the limit are skipped, and reported as such.
+    Every case is repeated and the best time of each stage is kept.
+    :return: The report, as a dictionary ready to be serialized
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix="matcha_bench_") as workdir:
+        for grid in grids:
+            for tiles_count in tiles_counts:
+                for stack_name in stacks:
+                    for reinsertion in reinsertion_modes:
+                        case = {"grid": list(grid), "tiles": tiles_count, "operators": stack_name,
+                                "reinsertion": reinsertion}
+                        if grid[0] * grid[1] * tiles_count > max_pairs:
+                            print(f"Skipping {case_key(case)}: too many cell-tile pairs")
+                            case["skipped"] = True
+                            results.append(case)
+                            continue
+                        runs = [run_case(workdir, grid, tiles_count, stack_name, reinsertion, seed)
+                                for _ in range(repeats)]
+                        case["seconds"] = {stage: min(r[stage] for r in runs) for stage in STAGES}
+                        case["seconds"]["total"] = sum(case["seconds"][stage] for stage in STAGES)
+                        case["counters"] = runs[-1]["counters"]
+                        print(f"{case_key(case)}: {case['seconds']['total']:.3f}s")
+                        results.append(case)
+    return {"version": REPORT_VERSION, "environment": environment_info(), "results": results}
+
+
+def compare_reports(current: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE,
+                    min_seconds: float = DEFAULT_MIN_SECONDS) -> [str]:
+    """
+    Compares two reports, looking for the stages that got slower.
+    A stage is a regression only if it got slower both by the relative tolerance and by the absolute amount.
+    :param current: The report of the version under test
+    :param baseline: The report of the reference version
+    :param tolerance: The relative slowdown allowed before reporting a regression (0.25 means 25%)
+    :param min_seconds: The absolute slowdown allowed before reporting a regression, in seconds
+    :return: The description of every regression found
+    """
+    reference = {case_key(c): c for c in baseline["results"] if "seconds" in c}
+    regressions = []
+    for case in current["results"]:
+        if "seconds" not in case or case_key(case) not in reference:
+            continue
+        for (stage, seconds) in case["seconds"].items():
+            before = reference[case_key(case)]["seconds"].get(stage)
+            if before and seconds > before * (1 + tolerance) and seconds - before > min_seconds:
+                regressions.append(f"{case_key(case)} {stage}: {before:.4f}s -> {seconds:.4f}s")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the mosaic pipeline on synthetic data")
+    parser.add_argument("--full", action="store_true", help="run the complete sweep instead of the quick one")
+    parser.add_argument("--grids", nargs="+", type=parse_grid, help="grid sizes, e.g. 10x10 200x200")
+    parser.add_argument("--tiles", nargs="+", type=int, help="numbers of tiles in the library")
+    parser.add_argument("--operators", nargs="+", choices=sorted(OPERATOR_STACKS), help="operators stacks")
+    parser.add_argument("--reinsertion", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--max-pairs", type=int, default=DEFAULT_MAX_PAIRS,
+                        help="skip the cases with more cell-tile pairs than this")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_report.json", help="path of the JSON report")
+    parser.add_argument("--compare", help="path of a previous report to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="ignore the slowdowns smaller than this, which are timing noise")
+    args = parser.parse_args()
+
+    report = run_suite(
+        grids=args.grids or (FULL_GRIDS if args.full else QUICK_GRIDS),
+        tiles_counts=args.tiles or (FULL_TILES_COUNTS if args.full else QUICK_TILES_COUNTS),
+        stacks=args.operators or (sorted(OPERATOR_STACKS) if args.full else QUICK_OPERATOR_STACKS),
+        reinsertion_modes={"on": [True], "off": [False], "both": REINSERTION_MODES}[args.reinsertion],
+        repeats=args.repeats,
+        max_pairs=args.max_pairs,
+        seed=args.seed
+    )
+    with open(args.output, mode='w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Report written to <{args.output}>")
+
+    if args.compare:
+        with open(args.compare, mode='r') as baseline_file:
+            regressions = compare_reports(report, json.load(baseline_file), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
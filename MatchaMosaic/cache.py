@@ -0,0 +1,124 @@
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+CACHE_FILE_SUFFIX = ".features.npz"
+CACHE_FORMAT_VERSION = 2
+# Number of configurations whose entries are kept in the same file
+MAX_CACHED_CONFIGS = 8
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_file(filepath: str) -> str:
+    """
+    Computes the hash of the content of a file, without decoding it.
+    :param filepath: The path of the file
+    :return: The hexadecimal digest of the file content
+    """
+    digest = hashlib.sha1()
+    with open(filepath, mode='rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Persistent cache of the coordinates of the tiles images, stored as a single ".npz" file.
+    Every entry is keyed by the content of the image file and by a fingerprint of the configuration that produced the
+    coordinates (e.g. the crop margins and the operators of the coordinator). The entries of every configuration are
+    kept in their own group, so that different configurations (e.g. RGB and CIELAB samplers) can share the file
+    without evicting each other; only the groups of the MAX_CACHED_CONFIGS most recently saved configurations are
+    kept. Changing the image makes the old entry unreachable: within the group of the current configuration, entries
+    that haven't been requested since the cache was opened are dropped when it's saved again.
+    """
+
+    def __init__(self, cachepath: str, fingerprint: str):
+        """
+        Opens the cache, loading the file if it exists.
+        A missing, unreadable or outdated file is silently treated as an empty cache.
+        :param cachepath: The path of the cache file
+        :param fingerprint: The description of the configuration used to compute the coordinates
+        """
+        self.__path = cachepath
+        self.__group = hashlib.sha1(fingerprint.encode()).hexdigest()
+        self.__entries = {}
+        # Keys and coordinates of the other configurations, most recently saved first; they're written back untouched
+        self.__others = {}
+        self.__used = {}
+        self.__keys = {}
+        self.__modified = False
+        if os.path.exists(cachepath):
+            try:
+                with np.load(cachepath) as data:
+                    if int(data["version"]) == CACHE_FORMAT_VERSION:
+                        for group in data["groups"].tolist():
+                            (keys, coords) = (data[f"keys_{group}"], data[f"coords_{group}"])
+                            if group == self.__group:
+                                self.__entries = dict(zip(keys.tolist(), coords))
+                            else:
+                                self.__others[group] = (keys, coords)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                self.__entries = {}
+                self.__others = {}
+                print(f"Ignoring unreadable features cache <{cachepath}>")
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def __key(self, filepath: str) -> str:
+        # Every file is hashed only once per session; the configuration is identified by the group
+        if filepath not in self.__keys:
+            self.__keys[filepath] = hash_file(filepath)
+        return self.__keys[filepath]
+
+    def get(self, filepath: str) -> np.ndarray:
+        """
+        Looks for the coordinates of an image file.
+        :param filepath: The path of the image file
+        :return: The cached coordinates, or None if the file has never been seen with the current configuration
+        """
+        key = self.__key(filepath)
+        coords = self.__entries.get(key)
+        if coords is not None:
+            self.__used[key] = coords
+        return coords
+
+    def put(self, filepath: str, coords: np.ndarray) -> None:
+        """
+        Stores the coordinates of an image file.
+        :param filepath: The path of the image file
+        :param coords: The coordinates computed from the image
+        """
+        key = self.__key(filepath)
+        self.__entries[key] = coords
+        self.__used[key] = coords
+        self.__modified = True
+
+    def save(self) -> None:
+        """
+        Writes the entries of the current configuration used since the cache was opened, discarding its other ones,
+        along with the entries of the other configurations.
+        The file is replaced atomically, so an interrupted write never leaves a corrupted cache.
+        """
+        if not self.__modified and len(self.__used) == len(self.__entries):
+            return
+        if not self.__used:
+            return
+        keys = list(self.__used.keys())
+        groups = {self.__group: (np.array(keys), np.stack([self.__used[k] for k in keys]))}
+        for (group, entries) in list(self.__others.items())[:MAX_CACHED_CONFIGS - 1]:
+            groups[group] = entries
+        arrays = {}
+        for (group, (group_keys, group_coords)) in groups.items():
+            arrays[f"keys_{group}"] = group_keys
+            arrays[f"coords_{group}"] = group_coords
+        # The temporary name has to end with ".npz", otherwise numpy appends the extension
+        tmp_path = self.__path + ".tmp.npz"
+        np.savez(tmp_path, version=CACHE_FORMAT_VERSION, groups=np.array(list(groups)), **arrays)
+        os.replace(tmp_path, self.__path)
+        self.__entries = dict(self.__used)
+        self.__modified = False
@@ -1,82 +1,281 @@
 import numpy as np
 
-from coordinates import Coordinator
-from tiles import Tile
+from distances import DISTANCE_DTYPE, distance_block, rank_tiles, stack_coordinates
+from instrumentation import INSTRUMENTATION
+from metrics import Metric, get_metric
+from spatial import TileIndex
+from tiles import Tile, TileLibrary
 
+# The cell has no tile assigned
+NO_TILE = -1
+ASSIGNED_DTYPE = np.int32
+DEFAULT_CELL_CANDIDATES = 64
 
-class Cell:
+
+class CellGrid:
     """
-    Class representing a single cell of a mosaic.
+    Compact representation of all the cells of a mosaic.
+    The data of the cells are kept in parallel arrays: the position of a cell is implied by its index (in row-major
+    order), the coordinates are the rows of a single (C, d) matrix and the assigned tiles are an array of indices.
+    The nearest tiles of every cell are found in one of two ways:
+    - With the k nearest candidates of every cell, stored as a (C, k) matrix of tile indices along with their distances.
+      The candidates of a cell are discarded in order as they run out; if all of them run out, they're replaced by the
+      k nearest tiles still available. With k equal to the number of tiles, this is the full ranking of the tiles.
+    - With a nearest-neighbour index over the tiles, shared by all the cells.
+    The grid behaves like a list of Cell objects: every cell is a view over one of its entries.
     """
 
-    def __init__(self, position: (int, int), img_cut: np.ndarray, coordinator: Coordinator, tiles: [Tile]):
+    def __init__(self, grid: (int, int), coords: np.ndarray, tiles: [Tile], candidates: np.ndarray = None,
+                 distances: np.ndarray = None, index: TileIndex = None, metric: Metric = None):
         """
-        Creates a cell from an image cut.
-        :param position: The number of row and column identifying the cell (a tuple)
-        :param img_cut: The numpy array representing the portion of image
-        :param tiles: the referencing tiles
+        Constructor.
+        :param grid: The number of rows and columns of cells
+        :param coords: The (C, d) matrix of the cells coordinates
+        :param tiles: The tiles (a list or a TileLibrary)
+        :param candidates: The (C, k) matrix of the nearest tiles of every cell, ordered by increasing distance
+        :param distances: The (C, k) matrix of the distances of the candidates
+        :param index: The index of the tiles coordinates; if given, the candidates are not used
+        :param metric: The distance between the coordinates, the same used to find the candidates; the euclidean one
+        if not given
         """
-        self.__pos = position
-        self.coords = coordinator.compute(img_cut)
-        # Order the tiles by increasing distances
-        self.tiles = sorted(tiles, key=lambda x: self.measure_distance(x))
-        self.assigned_tile = None
-        # print("Cell creation completed")
+        n_cells = grid[0] * grid[1]
+        if coords.shape[0] != n_cells:
+            raise Exception(f"Inconsistent cells data: {coords.shape[0]} coordinates for a grid {grid}")
+        if index is None and (candidates is None or distances is None):
+            raise Exception("The cells need either the candidate tiles with their distances, or an index")
+        self.grid = grid
+        self.coords = np.ascontiguousarray(coords, dtype=DISTANCE_DTYPE)
+        self.tiles = tiles
+        self.metric = get_metric(metric)
+        self.assigned = np.full(shape=n_cells, fill_value=NO_TILE, dtype=ASSIGNED_DTYPE)
+        self.candidates = None
+        self.candidate_distances = None
+        self.__index = index
+        if index is None:
+            # The candidates are copied, since they're replaced when they run out
+            self.candidates = np.array(candidates, dtype=ASSIGNED_DTYPE)
+            self.candidate_distances = np.array(distances, dtype=DISTANCE_DTYPE)
+            # Position of the first candidate of every cell that hasn't been discarded
+            self.__heads = np.zeros(shape=n_cells, dtype=ASSIGNED_DTYPE)
+        else:
+            # Nearest tile of every cell found through the index
+            self.__nearest = np.full(shape=n_cells, fill_value=NO_TILE, dtype=ASSIGNED_DTYPE)
+            self.__nearest_dist = np.zeros(shape=n_cells, dtype=DISTANCE_DTYPE)
+        self.__tiles_coords = tiles.coords if isinstance(tiles, TileLibrary) else None
+
+    def __len__(self) -> int:
+        return len(self.assigned)
+
+    def __getitem__(self, i: int) -> "Cell":
+        if not -len(self) <= i < len(self):
+            raise IndexError(f"Cell index {i} out of range")
+        return Cell(self, i % len(self))
+
+    def __iter__(self):
+        return (Cell(self, i) for i in range(len(self)))
 
     @property
-    def position(self) -> (int, int):
-        return self.__pos
+    def nbytes(self) -> int:
+        """
+        The bytes of the arrays holding the data of the cells.
+        """
+        arrays = [self.coords, self.assigned]
+        if self.__index is None:
+            arrays += [self.candidates, self.candidate_distances, self.__heads]
+        else:
+            arrays += [self.__nearest, self.__nearest_dist]
+        return sum(a.nbytes for a in arrays)
 
-    def get_nearest_available_tile_pair(self) -> (Tile, float):
+    def position(self, i: int) -> (int, int):
+        return divmod(i, self.grid[1])
+
+    def set_nearest(self, tile_indices: np.ndarray, distances: np.ndarray) -> None:
         """
-        Checks the mosaic tile in increasing distance order. The nearest one is returned, along with the distance.
-        If a tile is no more available (i.e. it has non-positive quantity), then it's removed from the list.
-        Note: the first available tile IS NOT removed. The deletion is done by another method.
-        :return: The nearest tile and the distance
-        """
-        curr_tile = self.tiles[0]
-        # Checks tile availability (quantity > 0)
-        while not curr_tile.is_available():
-            # Unavailable tiles are removed from the list
-            self.tiles.pop(0)
-            if not self.tiles:
-                raise Exception("Available list is empty: cannot find an usable tile")
-            curr_tile = self.tiles[0]
-        # Returns the tile and the associated distance
-        return curr_tile, self.measure_distance(curr_tile)
+        Sets the nearest tile of every cell, when it has been found by querying the index for all the cells at once.
+        :param tile_indices: The index of the nearest tile of every cell
+        :param distances: The distances of the nearest tiles
+        """
+        self.__nearest[:] = tile_indices
+        self.__nearest_dist[:] = distances
 
-    def get_nearest_distance(self) -> float:
+    def nearest_indices(self) -> np.ndarray:
         """
-        Checks the first mosaic tile available, then returns its distance (which is the minimum distance).
-        If a tile is no more available (i.e. it has non-positive quantity), then it's removed from the list.
-        :return: The minimum distance to the nearest tile
+        The nearest tile of every cell, without checking whether it's still available: it's the assignment of every
+        cell when the quantities never change.
+        :return: The index of the nearest tile of every cell
         """
-        curr_tile: Tile = self.tiles[0]
-        # Checks tile availability (quantity > 0)
-        while not curr_tile.is_available():
-            # Unavailable tiles are removed from the list
-            self.tiles.pop(0)
-            if not self.tiles:
+        if self.__index is None:
+            return self.candidates[np.arange(len(self)), self.__heads]
+        # The cells that haven't received their nearest tile from a batch query ask the index
+        for i in np.flatnonzero(self.__nearest == NO_TILE):
+            (self.__nearest[i], self.__nearest_dist[i]) = self.__index.query(self.coords[i])
+        return self.__nearest.copy()
+
+    def __is_available(self, tile_index: int) -> bool:
+        if isinstance(self.tiles, TileLibrary):
+            return self.tiles.quantities[tile_index] > 0
+        return self.tiles[tile_index].is_available()
+
+    def __count_unavailable(self, tile_indices: np.ndarray) -> int:
+        """
+        Counts the leading unavailable tiles of a list.
+        """
+        if isinstance(self.tiles, TileLibrary):
+            available = self.tiles.quantities[tile_indices] > 0
+            return int(np.argmax(available)) if available.any() else len(available)
+        skipped = 0
+        while skipped < len(tile_indices) and not self.tiles[tile_indices[skipped]].is_available():
+            skipped += 1
+        return skipped
+
+    def nearest(self, i: int) -> (int, float):
+        """
+        Finds the nearest available tile of a cell. Unavailable tiles are discarded for good.
+        :param i: The index of the cell
+        :return: The index of the nearest available tile and its distance
+        """
+        if self.__index is not None:
+            # Tiles that are no more available are removed from the index, so that no cell will find them again
+            while self.__nearest[i] == NO_TILE or not self.__is_available(self.__nearest[i]):
+                if self.__nearest[i] != NO_TILE:
+                    self.__index.remove(int(self.__nearest[i]))
+                (self.__nearest[i], self.__nearest_dist[i]) = self.__index.query(self.coords[i])
+            return int(self.__nearest[i]), float(self.__nearest_dist[i])
+
+        row = self.candidates[i]
+        k = len(row)
+        head = int(self.__heads[i])
+        while True:
+            if head < k and not self.__is_available(row[head]):
+                # Unavailable tiles are skipped, all at once
+                skipped = self.__count_unavailable(row[head:])
+                head += skipped
+                INSTRUMENTATION.count("unavailable_tiles_skipped", skipped)
+            if head < k:
+                break
+            if k >= len(self.tiles):
                 raise Exception("Available list is empty: cannot find an usable tile")
-            curr_tile = self.tiles[0]
-        # Returns the associated distance
-        return self.measure_distance(curr_tile)
+            self.__refill_candidates(i)
+            head = 0
+        self.__heads[i] = head
+        return int(row[head]), float(self.candidate_distances[i, head])
+
+    def __refill_candidates(self, i: int) -> None:
+        """
+        Replaces the candidates of a cell, once all of them have run out, with its nearest available tiles.
+        Since the quantities only decrease, the new candidates follow the discarded ones in the ranking of all the
+        tiles.
+        """
+        INSTRUMENTATION.count("candidates_exhausted")
+        if isinstance(self.tiles, TileLibrary):
+            available = self.tiles.available()
+        else:
+            available = np.array([t.is_available() for t in self.tiles])
+        if not available.any():
+            raise Exception("Available list is empty: cannot find an usable tile")
+        if self.__tiles_coords is None:
+            self.__tiles_coords = stack_coordinates([t.coords for t in self.tiles])
+        distances = distance_block(self.coords[i:i + 1], self.__tiles_coords, self.metric)
+        distances[:, ~available] = np.inf
+        ranking = rank_tiles(distances, self.candidates.shape[1])
+        self.candidates[i] = ranking[0]
+        self.candidate_distances[i] = distances[0, ranking[0]]
 
-    def assign_tile(self, decrease_availability: bool = True):
+    def assign(self, i: int, tile_index: int = None, decrease_availability: bool = True) -> None:
         """
-        Assign the cell to a tile.
-        This method decreases the availability of the tile, calling the method "use" on it.
+        Assigns a tile to a cell.
+        :param i: The index of the cell
+        :param tile_index: The index of the tile, when it has been chosen from outside; the nearest available one if
+        not given
+        :param decrease_availability: Whether the usage of the tile is registered
         """
-        if not self.tiles[0].is_available():
+        if tile_index is None:
+            (tile_index, _) = self.nearest(i)
+        tile = self.tiles[tile_index]
+        if not tile.is_available():
             raise Exception("Impossible to assign an unavailable tile to this cell")
-        self.assigned_tile = self.tiles[0]
+        self.assigned[i] = tile_index
         # If the usage has to be "registered"
         if decrease_availability:
-            self.assigned_tile.use()
+            tile.use()
+            # An exhausted tile is removed from the index right away, so that no other cell will find it
+            if self.__index is not None and not tile.is_available():
+                self.__index.remove(int(tile_index))
+
+    def assign_all(self, tile_indices: np.ndarray, decrease_availability: bool = True) -> None:
+        """
+        Assigns a tile to every cell at once.
+        :param tile_indices: The index of the tile of every cell
+        :param decrease_availability: Whether the usage of the tiles is registered
+        """
+        tile_indices = np.asarray(tile_indices, dtype=ASSIGNED_DTYPE)
+        if decrease_availability and isinstance(self.tiles, TileLibrary):
+            self.tiles.use_many(tile_indices)
+        elif decrease_availability:
+            counts = np.bincount(tile_indices, minlength=len(self.tiles))
+            for t in np.flatnonzero(counts):
+                self.tiles[t].use(int(counts[t]))
+        self.assigned[:] = tile_indices
+
+    def index_of(self, tile: Tile) -> int:
+        """
+        Finds the index of a tile among the tiles of the grid.
+        """
+        if tile.library is self.tiles:
+            return tile.index
+        return next(i for (i, t) in enumerate(self.tiles) if t is tile)
+
+    def assigned_tile(self, i: int) -> Tile:
+        tile_index = self.assigned[i]
+        return self.tiles[tile_index] if tile_index != NO_TILE else None
+
+
+class Cell:
+    """
+    Class representing a single cell of a mosaic.
+    It's a lightweight view over one entry of a CellGrid, which holds the data of all the cells.
+    """
+
+    __slots__ = ("__grid", "__index")
+
+    def __init__(self, grid: CellGrid, index: int):
+        self.__grid = grid
+        self.__index = index
+
+    @property
+    def grid(self) -> CellGrid:
+        return self.__grid
+
+    @property
+    def index(self) -> int:
+        return self.__index
+
+    @property
+    def position(self) -> (int, int):
+        return self.__grid.position(self.__index)
+
+    @property
+    def coords(self) -> np.ndarray:
+        return self.__grid.coords[self.__index]
+
+    @property
+    def assigned_tile(self) -> Tile:
+        return self.__grid.assigned_tile(self.__index)
+
+    def get_nearest_available_tile_pair(self) -> (Tile, float):
+        (tile_index, distance) = self.__grid.nearest(self.__index)
+        return self.__grid.tiles[tile_index], distance
+
+    def get_nearest_distance(self) -> float:
+        return self.__grid.nearest(self.__index)[1]
+
+    def assign_tile(self, decrease_availability: bool = True, tile: Tile = None):
+        tile_index = self.__grid.index_of(tile) if tile is not None else None
+        self.__grid.assign(self.__index, tile_index, decrease_availability)
 
     def has_tile_assigned(self) -> bool:
-        return self.assigned_tile is not None
+        return self.__grid.assigned[self.__index] != NO_TILE
 
     def measure_distance(self, tile: Tile) -> float:
-        dist = np.linalg.norm(self.coords - tile.coords)
-        return dist
+        INSTRUMENTATION.count("distances_evaluated")
+        return float(self.__grid.metric.paired(self.coords[np.newaxis, :], tile.coords[np.newaxis, :])[0])
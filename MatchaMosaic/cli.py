@@ -0,0 +1,97 @@
+"""
+Command-line entry point, composing the mosaic of a single target.
+Nothing is shown by default: the mosaic is written to the output file, so the program can run on servers without a
+display. Matplotlib is only imported if the preview is requested.
+
+Usage:
+    python cli.py image/shrek3.jpg --tiles tiles/tiles_info.csv --grid 42x57 --output shrek3_mosaic.png
+    python cli.py image/shrek3.jpg --tiles tiles/tiles_info.csv --operators 1x1 4x4 --reinsertion --preview
+    python cli.py image/shrek3.jpg --tiles tiles/tiles_info.csv --operators 1x1 8x8 --shortlist 32 --output out.png
+"""
+import argparse
+import sys
+from math import sqrt
+
+from arguments import add_library_arguments, load_library
+from coordinates import COLOR_SPACE_LAB, COLOR_SPACE_RGB
+from instrumentation import INSTRUMENTATION
+from metrics import DEFAULT_METRIC, METRIC_DELTA_E, METRICS
+from mosaic import Mosaic, DEFAULT_SOLVER, DEFAULT_WORKERS, SOLVER_GREEDY, SOLVER_OPTIMAL
+from pruning import DEFAULT_COMPONENTS, CoarseToFineMatcher
+from tiles import TileFactory
+from utilities import save_image, show_image
+
+
+def parse_arguments(argv: [str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Composes the mosaic of a target image with the given tiles")
+    parser.add_argument("target", help="path of the target image")
+    add_library_arguments(parser)
+    parser.add_argument("--reinsertion", action="store_true", help="use the tiles without limits")
+    parser.add_argument("--solver", choices=[SOLVER_GREEDY, SOLVER_OPTIMAL], default=DEFAULT_SOLVER)
+    parser.add_argument("--metric", choices=sorted(METRICS), default=DEFAULT_METRIC,
+                        help="distance between the cells and the tiles; \"delta_e\" samples the colors in CIELAB")
+    parser.add_argument("--shortlist", type=int,
+                        help="find the nearest tiles in two stages, comparing the full coordinates only with this many "
+                             "tiles per cell, shortlisted on reduced coordinates")
+    parser.add_argument("--coarse-components", type=int, default=DEFAULT_COMPONENTS,
+                        help="principal components of the reduced coordinates of the shortlist")
+    parser.add_argument("--coarse-operator", type=int,
+                        help="use the coordinates of this operator (by position) for the shortlist, instead of the "
+                             "principal components")
+    parser.add_argument("--target-recall", type=float,
+                        help="grow the shortlist until this fraction of the real nearest tiles is found")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of workers computing the tiles features and the nearest tiles")
+    parser.add_argument("--no-cache", action="store_true", help="don't read nor write the tiles features cache")
+    parser.add_argument("--output", help="path of the mosaic image")
+    parser.add_argument("--preview", action="store_true", help="show the mosaic in a window")
+    args = parser.parse_args(argv)
+    if args.output is None and not args.preview:
+        parser.error("nothing to do: please give an --output path, or ask for the --preview")
+    if args.shortlist is None and (args.coarse_operator is not None or args.target_recall is not None):
+        parser.error("the options of the two-stage search need a --shortlist")
+    return args
+
+
+def main(argv: [str] = None) -> int:
+    args = parse_arguments(argv)
+    # The perceptual distance compares colors converted once to CIELAB, when the features are computed
+    color_space = COLOR_SPACE_LAB if args.metric == METRIC_DELTA_E else COLOR_SPACE_RGB
+    (coordinator, tiles) = load_library(args, color_space=color_space, use_cache=not args.no_cache,
+                                        workers=args.workers)
+
+    total = TileFactory.count_quantity(tiles_list=tiles)
+    print(f"Based on the tiles quantity ({total}), the average side lenght of the mosaic is: {sqrt(total)}")
+    matcher = None
+    if args.shortlist is not None:
+        # The samplers' number of coordinates only depends on the channels of the images
+        columns = coordinator.get_slices((1, 1, 3))[args.coarse_operator] if args.coarse_operator is not None else None
+        matcher = CoarseToFineMatcher(shortlist=args.shortlist, components=args.coarse_components, columns=columns,
+                                      target_recall=args.target_recall)
+    mosaic = Mosaic(targetpath=args.target, coordinator=coordinator, tiles=tiles, grid=args.grid,
+                    reinsertion=args.reinsertion, workers=args.workers, solver=args.solver,
+                    metric=args.metric, matcher=matcher)
+    if matcher is not None and matcher.recall is not None:
+        print(f"Two-stage search: shortlist of {matcher.shortlist_used} tiles, recall {matcher.recall:.3f} "
+              f"against the exhaustive search")
+    mosaic.assign_tiles()
+    image = mosaic.render()
+
+    if args.output is not None:
+        try:
+            save_image(args.output, image)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f"Mosaic written to <{args.output}>")
+    if args.preview:
+        show_image(image)
+
+    # Enabled with the environment variable MATCHA_INSTRUMENTATION=1
+    if INSTRUMENTATION.enabled:
+        print(INSTRUMENTATION.to_json())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,78 @@
-import numpy as np
+import inspect
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 ZERO_THRESHOLD: float = 1e-10
+COLOR_SPACE_RGB = "rgb"
+COLOR_SPACE_LAB = "lab"
+# Grids of the average samplers used by the command-line tools
+DEFAULT_OPERATORS = [(1, 1), (2, 2)]
+
+# Conversion from linear sRGB to CIE XYZ, and reference white D65
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(colors: np.ndarray) -> np.ndarray:
+    """
+    Converts sRGB colors to the CIELAB space (illuminant D65).
+    :param colors: The colors, with values in [0, 255] and the channels on the last axis
+    :return: The L*, a* and b* components, with the same shape
+    """
+    rgb = np.asarray(colors, dtype=np.float64) / 255
+    # Removing the gamma of the sRGB encoding
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = (linear @ _RGB_TO_XYZ.T) / _WHITE_D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+class SummedAreaTable:
+    """
+    Summed-area table (or integral image) of an image.
+    Each entry contains the sum of all the pixels above and on the left of it, so that the sum of any rectangular
+    region can be computed with four lookups, regardless of its size.
+    """
+
+    def __init__(self, img: np.ndarray):
+        """
+        Builds the table in a single pass over the image.
+        :param img: The image, as a numpy array with shape (height, width, channels)
+        """
+        if img is None:
+            raise Exception("Impossible to compute the summed-area table of a null image")
+        (height, width, channels) = img.shape
+        self.__image = img
+        # The first row and column are left to zero, so that no region needs a special case
+        self.__table = np.zeros(shape=(height + 1, width + 1, channels), dtype=np.int64)
+        np.cumsum(np.cumsum(img, axis=0, dtype=np.int64), axis=1, out=self.__table[1:, 1:])
+
+    @property
+    def image(self) -> np.ndarray:
+        return self.__image
+
+    def region_sums(self, tops: np.ndarray, lefts: np.ndarray, height: int, width: int) -> np.ndarray:
+        """
+        Computes the sum of many regions with the same size at once.
+        The arrays of the top and left corners are broadcast together, and the result has their broadcast shape
+        plus a last axis for the channels.
+        :param tops: The row of the top-left corner of every region
+        :param lefts: The column of the top-left corner of every region
+        :param height: The height of the regions
+        :param width: The width of the regions
+        :return: The sum of every region, for each channel of the image
+        """
+        t = self.__table
+        bottoms = tops + height
+        rights = lefts + width
+        return t[bottoms, rights] - t[tops, rights] - t[bottoms, lefts] + t[tops, lefts]
 
 
 class Operator(ABC):
@@ -29,20 +100,97 @@ class Operator(ABC):
         """
         pass
 
+    def get_dimension(self, img_shape: (int, int, int)) -> int:
+        """
+        Returns the length of the vector of coordinates computed for an image with the given shape.
+        Operators that know their output size should override this method; the default implementation runs "compute"
+        on a blank image.
+        :param img_shape: The shape of the input images (height, width, channels)
+        :return: The number of coordinates
+        """
+        return self.compute(np.zeros(shape=img_shape, dtype=np.uint8)).size
+
+    def compute_batch(self, stack: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Computes the vectors of coordinates of many images with the same shape at once.
+        Operators that can work on the whole stack should override this method; the default implementation simply
+        calls "compute" on every image.
+        Overrides can accept the "out" matrix, or only the stack: in both cases the returned matrix is the result, and
+        "out" is just a hint to avoid a copy.
+        :param stack: The images, as a numpy array with shape (N, height, width, channels)
+        :param out: An optional (N, d) matrix where the coordinates are written
+        :return: The (N, d) matrix of coordinates, one row per image
+        """
+        if out is None:
+            out = np.empty(shape=(stack.shape[0], self.get_dimension(stack.shape[1:])))
+        for (i, img) in enumerate(stack):
+            out[i] = self.compute(img)
+        return out
+
+    def compute_grid(self, table: SummedAreaTable, cell_shape: (int, int), grid: (int, int)) -> np.ndarray:
+        """
+        Computes the coordinates of every cell of a grid laid over an image, starting from the top-left corner.
+        Operators that can work on the summed-area table should override this method; the default implementation
+        simply calls "compute" on every cell.
+        :param table: The summed-area table of the image
+        :param cell_shape: The height and width of every cell
+        :param grid: The number of rows and columns of cells
+        :return: The matrix of coordinates, with one row per cell (in row-major order)
+        """
+        (cell_h, cell_w) = cell_shape
+        img = table.image
+        coords = [
+            self.compute(img[i * cell_h:(i + 1) * cell_h, j * cell_w:(j + 1) * cell_w, :])
+            for i in range(grid[0])
+            for j in range(grid[1])
+        ]
+        return np.array(coords)
+
     @property
     def weight(self):
         return self.__weight
 
+    @property
+    def color_space(self) -> str:
+        """
+        The space of the colors described by the coordinates, or None if the operator doesn't work on colors.
+        """
+        return None
+
 
 class AverageSamplerOperator(Operator):
 
     DEFAULT_SAMPLING_GRID = (1, 1)
 
-    def __init__(self, grid: (int, int) = DEFAULT_SAMPLING_GRID, weight: float = 1):
+    def __init__(self, grid: (int, int) = DEFAULT_SAMPLING_GRID, weight: float = 1,
+                 color_space: str = COLOR_SPACE_RGB):
+        """
+        Constructor.
+        :param grid: The number of rows and columns of the sub-cells whose average colors are sampled
+        :param weight: The weight of the operator
+        :param color_space: The space of the sampled colors: "rgb", or "lab" for the CIELAB space. The average colors
+        are converted once, here, so that the metrics can compare them directly (see metrics.DeltaEMetric).
+        """
         super().__init__(weight)
         if grid[0] <= 0 or grid[1] <= 0:
             raise Exception(f"Illegal grid values: {grid}. Please use only positive values.")
+        if color_space not in (COLOR_SPACE_RGB, COLOR_SPACE_LAB):
+            raise Exception(f"Unknown color space: {color_space}. Please use \"{COLOR_SPACE_RGB}\" or "
+                            f"\"{COLOR_SPACE_LAB}\".")
         self.__grid = grid
+        self.__color_space = color_space
+
+    @property
+    def color_space(self) -> str:
+        return self.__color_space
+
+    def __convert(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Converts the average colors (with the channels on the last axis) to the color space of the operator.
+        """
+        if self.__color_space == COLOR_SPACE_LAB:
+            return rgb_to_lab(colors)
+        return colors
 
     @staticmethod
     def sample_color(img_cut):
@@ -73,7 +221,41 @@ class AverageSamplerOperator(Operator):
                 img_cell = img_cut[verti_slice, horiz_slice, :]
                 colors[i, j] = self.sample_color(img_cell)
 
-        return colors.flatten() * self.weight
+        return self.__convert(colors).flatten() * self.weight
+
+    def get_dimension(self, img_shape: (int, int, int)) -> int:
+        return self.__grid[0] * self.__grid[1] * img_shape[2]
+
+    def compute_batch(self, stack: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        (n, height, width, channels) = stack.shape
+        cell_h = height // self.__grid[0]
+        cell_w = width // self.__grid[1]
+        if cell_h == 0 or cell_w == 0:
+            raise Exception("Found sub-image with a 0 dimension")
+
+        # Splitting every image into its sub-cells, with axes (image, row, sub-row, column, sub-column, channel)
+        cropped = stack[:, :self.__grid[0] * cell_h, :self.__grid[1] * cell_w, :]
+        blocks = cropped.reshape(n, self.__grid[0], cell_h, self.__grid[1], cell_w, channels)
+        colors = self.__convert(blocks.mean(axis=(2, 4), dtype=np.float64))
+
+        if out is None:
+            out = np.empty(shape=(n, self.get_dimension(stack.shape[1:])))
+        np.multiply(colors.reshape(n, -1), self.weight, out=out)
+        return out
+
+    def compute_grid(self, table: SummedAreaTable, cell_shape: (int, int), grid: (int, int)) -> np.ndarray:
+        (cell_h, cell_w) = cell_shape
+        sub_h = cell_h // self.__grid[0]
+        sub_w = cell_w // self.__grid[1]
+        if sub_h == 0 or sub_w == 0:
+            raise Exception("Found sub-image with a 0 dimension")
+
+        # Corners of every sub-cell, with axes (row, column, sub-row, sub-column)
+        tops = (np.arange(grid[0]) * cell_h)[:, None, None, None] + (np.arange(self.__grid[0]) * sub_h)[:, None]
+        lefts = (np.arange(grid[1]) * cell_w)[None, :, None, None] + (np.arange(self.__grid[1]) * sub_w)[None, :]
+        colors = self.__convert(table.region_sums(tops, lefts, sub_h, sub_w) / (sub_h * sub_w))
+
+        return colors.reshape(grid[0] * grid[1], -1) * self.weight
 
 
 class Coordinator:
@@ -113,6 +295,38 @@ class Coordinator:
         self.__finalized = True
         return aux
 
+    def fingerprint(self) -> str:
+        """
+        Describes the operators of the coordinator, along with their parameters and weights.
+        Two coordinators with the same fingerprint compute the same coordinates for the same image.
+        :return: A string identifying the configuration of the coordinator
+        """
+        return ";".join(
+            f"{type(op).__module__}.{type(op).__qualname__}{sorted(vars(op).items())}"
+            for op in self.__operators
+        )
+
+    @property
+    def color_spaces(self) -> {str}:
+        """
+        The color spaces of the coordinates computed by the operators.
+        """
+        return {op.color_space for op in self.__operators if op.color_space is not None}
+
+    def get_slices(self, img_shape: (int, int, int)) -> [slice]:
+        """
+        Finds the columns of the coordinates computed by every operator, in the order the operators were added.
+        :param img_shape: The shape of the images (height, width, channels)
+        :return: The slice of the columns of every operator
+        """
+        slices = []
+        start = 0
+        for op in self.__operators:
+            dim = op.get_dimension(img_shape)
+            slices.append(slice(start, start + dim))
+            start += dim
+        return slices
+
     def compute(self, img) -> np.ndarray:
         """
         Given an image, this method computes a vector of coordinates (i.e. of features that will place the image in the
@@ -126,3 +340,64 @@ class Coordinator:
         for op in self.__operators:
             coords.extend(op.compute(img))
         return np.array(coords)
+
+    def compute_batch(self, stack: np.ndarray) -> np.ndarray:
+        """
+        Computes the vectors of coordinates of many images with the same shape at once.
+        The output matrix is allocated only once: every operator writes its own block of columns in place.
+        Operators that don't provide a batch implementation are computed one image at a time; the result of an operator
+        which doesn't write in place is copied into its block.
+        :param stack: The images, as a numpy array with shape (N, height, width, channels)
+        :return: A matrix of coordinates with one row per image
+        """
+        if not self.__finalized:
+            raise Exception("Cannot use a coordinator until it's been finalized")
+        if stack.ndim != 4:
+            raise Exception(f"Expected a stack of images with shape (N, height, width, channels), found {stack.shape}")
+        dimensions = [op.get_dimension(stack.shape[1:]) for op in self.__operators]
+        coords = np.empty(shape=(stack.shape[0], sum(dimensions)))
+        start = 0
+        for (op, dim) in zip(self.__operators, dimensions):
+            block = coords[:, start:start + dim]
+            if "out" in inspect.signature(op.compute_batch).parameters:
+                result = op.compute_batch(stack, out=block)
+            else:
+                result = op.compute_batch(stack)
+            if result is not block:
+                block[:] = np.reshape(result, block.shape)
+            start += dim
+        return coords
+
+    def compute_grid(self, img, grid: (int, int)) -> np.ndarray:
+        """
+        Divides the image into a grid of cells, then computes the vector of coordinates of every cell.
+        The summed-area table of the image is built only once and it's shared by all the operators, so that the cost
+        depends on the number of pixels plus the number of cells, and not on their product.
+        If the image size is not a multiple of the grid, the remaining pixels on the bottom and on the right are
+        ignored.
+        :param img: The whole image, as a numpy array
+        :param grid: The number of rows and columns of cells
+        :return: A matrix of coordinates with one row per cell, in row-major order
+        """
+        if not self.__finalized:
+            raise Exception("Cannot use a coordinator until it's been finalized")
+        cell_shape = (img.shape[0] // grid[0], img.shape[1] // grid[1])
+        if cell_shape[0] == 0 or cell_shape[1] == 0:
+            raise Exception(f"The grid {grid} is too thick for an image with shape {img.shape}")
+        table = SummedAreaTable(img)
+        blocks = [op.compute_grid(table, cell_shape, grid) for op in self.__operators]
+        return np.concatenate(blocks, axis=1)
+
+
+def build_coordinator(grids: [(int, int)], color_space: str = COLOR_SPACE_RGB) -> Coordinator:
+    """
+    Creates a finalized coordinator made of average samplers.
+    :param grids: The sampling grid of every operator, e.g. [(1, 1), (2, 2)]
+    :param color_space: The color space of all the samplers
+    :return: The coordinator
+    """
+    coordinator = Coordinator()
+    for grid in grids:
+        coordinator.add_operator(AverageSamplerOperator(grid=grid, color_space=color_space))
+    coordinator.finalize()
+    return coordinator
@@ -0,0 +1,226 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from instrumentation import INSTRUMENTATION
+
+DISTANCE_DTYPE = np.float32
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def stack_coordinates(coords_list: [np.ndarray]) -> np.ndarray:
+    """
+    Stacks a list of coordinates vectors into a single matrix, one row per vector.
+    :param coords_list: The coordinates vectors, all with the same length
+    :return: The (N, d) matrix of coordinates, with <float32> data type
+    """
+    if len(coords_list) == 0:
+        raise Exception("Cannot stack an empty list of coordinates")
+    return np.stack(coords_list).astype(DISTANCE_DTYPE, copy=False)
+
+
+def compute_distance_matrix(cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+    """
+    Computes the euclidean distance between every cell and every tile in a single pass.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param tiles_coords: The (T, d) matrix of the tiles coordinates
+    :return: The (C, T) matrix of distances, with <float32> data type
+    """
+    INSTRUMENTATION.count("distances_evaluated", cells_coords.shape[0] * tiles_coords.shape[0])
+    return euclidean_distance_matrix(cells_coords, tiles_coords)
+
+
+def euclidean_distance_matrix(cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+    """
+    Computes the euclidean distance between every cell and every tile, without counting the evaluations.
+    The squared distances are expanded as ||a||^2 + ||b||^2 - 2ab, so that the heavy part is one matrix product.
+    Both matrices are centered on the mean of the tiles before the expansion: the distances do not change, but the
+    norms get smaller and the cancellation error of the float32 arithmetic is reduced.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param tiles_coords: The (T, d) matrix of the tiles coordinates
+    :return: The (C, T) matrix of distances, with <float32> data type
+    """
+    if cells_coords.ndim != 2 or tiles_coords.ndim != 2:
+        raise Exception("The coordinates have to be expressed as 2D matrices")
+    if cells_coords.shape[1] != tiles_coords.shape[1]:
+        raise Exception(f"Incompatible coordinates: cells have {cells_coords.shape[1]} features, "
+                        f"tiles have {tiles_coords.shape[1]}")
+    center = tiles_coords.mean(axis=0)
+    a = (cells_coords - center).astype(DISTANCE_DTYPE, copy=False)
+    b = (tiles_coords - center).astype(DISTANCE_DTYPE, copy=False)
+
+    sq_dist = a @ b.T
+    sq_dist *= -2
+    sq_dist += np.einsum("ij,ij->i", a, a)[:, np.newaxis]
+    sq_dist += np.einsum("ij,ij->i", b, b)[np.newaxis, :]
+    # Rounding errors can produce tiny negative values
+    np.maximum(sq_dist, 0, out=sq_dist)
+    return np.sqrt(sq_dist, out=sq_dist)
+
+
+def distance_block(cells_coords: np.ndarray, tiles_coords: np.ndarray, metric=None) -> np.ndarray:
+    """
+    Computes the distance between every cell and every tile with the given metric.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param tiles_coords: The (T, d) matrix of the tiles coordinates
+    :param metric: The metric (see metrics.Metric); the euclidean distance if None
+    :return: The (C, T) matrix of distances, with <float32> data type
+    """
+    if metric is None:
+        return compute_distance_matrix(cells_coords, tiles_coords)
+    INSTRUMENTATION.count("distances_evaluated", cells_coords.shape[0] * tiles_coords.shape[0])
+    return np.asarray(metric.pairwise(cells_coords, tiles_coords), dtype=DISTANCE_DTYPE)
+
+
+def rank_tiles(distances: np.ndarray, k: int = None) -> np.ndarray:
+    """
+    Orders the tiles of every cell by increasing distance.
+    If only the first k tiles are requested, they're selected with a partition before being sorted.
+    Tiles with the same distance keep their original order.
+    :param distances: The (C, T) matrix of distances
+    :param k: The number of nearest tiles to keep for each cell; all of them if not specified
+    :return: The (C, k) matrix of the tiles indices, ordered by increasing distance
+    """
+    INSTRUMENTATION.count("sort_calls")
+    n_tiles = distances.shape[1]
+    if k is None or k >= n_tiles:
+        return np.argsort(distances, axis=1, kind="stable")
+    if k <= 0:
+        raise Exception(f"Illegal number of nearest tiles: {k}. Please use a positive value.")
+    candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    # Sorting the candidates by distance first, then by index to keep the ties stable
+    candidates.sort(axis=1)
+    candidates_dist = np.take_along_axis(distances, candidates, axis=1)
+    order = np.argsort(candidates_dist, axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def _nearest_in_chunk(cells_coords: np.ndarray, tiles_coords: np.ndarray, bounds: (int, int),
+                      indices: np.ndarray, distances: np.ndarray, metric=None) -> None:
+    """
+    Finds the nearest tile of the cells in a range, writing the results in the output arrays.
+    """
+    (start, end) = bounds
+    block = distance_block(cells_coords[start:end], tiles_coords, metric)
+    nearest = np.argmin(block, axis=1)
+    indices[start:end] = nearest
+    distances[start:end] = block[np.arange(end - start), nearest]
+
+
+def _attach_shared_array(name: str, shape: tuple, dtype) -> (shared_memory.SharedMemory, np.ndarray):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape=shape, dtype=dtype, buffer=shm.buf)
+
+
+def _nearest_in_shared_chunk(specs: dict, bounds: (int, int), metric=None) -> None:
+    """
+    Worker of the process pool: attaches to the shared matrices and processes a range of cells.
+    :param specs: The name, shape and data type of every shared array
+    :param bounds: The range of cells to process
+    :param metric: The metric, sent along with every chunk
+    """
+    attached = {key: _attach_shared_array(*spec) for (key, spec) in specs.items()}
+    try:
+        arrays = {key: array for (key, (_, array)) in attached.items()}
+        _nearest_in_chunk(arrays["cells"], arrays["tiles"], bounds, arrays["indices"], arrays["distances"],
+                          metric)
+    finally:
+        # The views must be released before closing the shared memory
+        arrays = None
+        for (shm, _) in attached.values():
+            shm.close()
+
+
+def nearest_tiles(cells_coords: np.ndarray, tiles_coords: np.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  workers: int = 1, use_processes: bool = False, metric=None) -> (np.ndarray, np.ndarray):
+    """
+    Finds the nearest tile of every cell, without ranking all the tiles.
+    The cells are processed in chunks, so that only a (chunk_size, T) block of distances exists at any time. The chunks
+    can be spread across a pool of threads (NumPy releases the GIL during the matrix products) or of processes; in the
+    latter case the coordinates and the results are exchanged through shared memory, without copies.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param tiles_coords: The (T, d) matrix of the tiles coordinates
+    :param chunk_size: The number of cells processed together
+    :param workers: The number of threads or processes; 1 means that everything runs in the calling thread
+    :param use_processes: Whether a pool of processes is used instead of a pool of threads
+    :param metric: The metric (see metrics.Metric); the euclidean distance if None
+    :return: The array of the indices of the nearest tiles and the array of their distances
+    """
+    if chunk_size <= 0:
+        raise Exception(f"Illegal chunk size: {chunk_size}. Please use a positive value.")
+    if workers is None or workers < 1:
+        raise Exception(f"Illegal number of workers: {workers}. Please use a positive value.")
+    cells_coords = np.ascontiguousarray(cells_coords, dtype=DISTANCE_DTYPE)
+    tiles_coords = np.ascontiguousarray(tiles_coords, dtype=DISTANCE_DTYPE)
+    n_cells = cells_coords.shape[0]
+    chunks = [(start, min(start + chunk_size, n_cells)) for start in range(0, n_cells, chunk_size)]
+
+    if workers == 1 or len(chunks) == 1:
+        indices = np.empty(shape=n_cells, dtype=np.intp)
+        distances = np.empty(shape=n_cells, dtype=DISTANCE_DTYPE)
+        for bounds in chunks:
+            _nearest_in_chunk(cells_coords, tiles_coords, bounds, indices, distances, metric)
+        return indices, distances
+
+    if not use_processes:
+        indices = np.empty(shape=n_cells, dtype=np.intp)
+        distances = np.empty(shape=n_cells, dtype=DISTANCE_DTYPE)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consuming the results, so that the exceptions are raised
+            list(executor.map(lambda b: _nearest_in_chunk(cells_coords, tiles_coords, b, indices, distances, metric),
+                              chunks))
+        return indices, distances
+
+    # Allocating the shared arrays: inputs are copied once, outputs are written in place by the workers
+    layout = {
+        "cells": (cells_coords.shape, DISTANCE_DTYPE),
+        "tiles": (tiles_coords.shape, DISTANCE_DTYPE),
+        "indices": ((n_cells,), np.intp),
+        "distances": ((n_cells,), DISTANCE_DTYPE),
+    }
+    segments = {}
+    try:
+        for (key, (shape, dtype)) in layout.items():
+            size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            segments[key] = shared_memory.SharedMemory(create=True, size=size)
+        arrays = {key: np.ndarray(shape=shape, dtype=dtype, buffer=segments[key].buf)
+                  for (key, (shape, dtype)) in layout.items()}
+        arrays["cells"][:] = cells_coords
+        arrays["tiles"][:] = tiles_coords
+        specs = {key: (segments[key].name, shape, dtype) for (key, (shape, dtype)) in layout.items()}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_nearest_in_shared_chunk, repeat(specs), chunks, repeat(metric)))
+        indices = arrays["indices"].copy()
+        distances = arrays["distances"].copy()
+        arrays = None
+        return indices, distances
+    finally:
+        for shm in segments.values():
+            shm.close()
+            shm.unlink()
+
+
+def candidate_tiles(cells_coords: np.ndarray, tiles_coords: np.ndarray, k: int,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE, metric=None) -> (np.ndarray, np.ndarray):
+    """
+    Finds the k nearest tiles of every cell, processing the cells in chunks so that the whole distance matrix is
+    never allocated.
+    :param cells_coords: The (C, d) matrix of the cells coordinates
+    :param tiles_coords: The (T, d) matrix of the tiles coordinates
+    :param k: The number of candidates of every cell
+    :param chunk_size: The number of cells processed together
+    :param metric: The metric (see metrics.Metric); the euclidean distance if None
+    :return: The (C, k) matrix of the candidate tiles, ordered by increasing distance, and the matrix of their distances
+    """
+    k = min(k, tiles_coords.shape[0])
+    n_cells = cells_coords.shape[0]
+    candidates = np.empty(shape=(n_cells, k), dtype=np.intp)
+    distances = np.empty(shape=(n_cells, k), dtype=DISTANCE_DTYPE)
+    for start in range(0, n_cells, chunk_size):
+        block = distance_block(cells_coords[start:start + chunk_size], tiles_coords, metric)
+        ranking = rank_tiles(block, k)
+        candidates[start:start + chunk_size] = ranking
+        distances[start:start + chunk_size] = np.take_along_axis(block, ranking, axis=1)
+    return candidates, distances
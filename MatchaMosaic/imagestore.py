@@ -0,0 +1,109 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import INSTRUMENTATION
+
+RAW_IMAGE_EXTENSION = ".npy"
+DEFAULT_BUDGET_BYTES = 256 * 1024 * 1024
+
+
+def save_raw_image(img: np.ndarray, filepath: str) -> None:
+    """
+    Saves the pixels of an image as they are, in a file that can be memory-mapped.
+    Reading the file back doesn't need any decoding.
+    :param img: The image, as a numpy array
+    :param filepath: The path of the file; it should have the ".npy" extension
+    """
+    np.save(filepath, np.ascontiguousarray(img))
+
+
+def load_raw_image(filepath: str) -> np.ndarray:
+    """
+    Maps a raw image file into memory. The pixels are read from the disk only when they're accessed.
+    :param filepath: The path of the ".npy" file
+    :return: The image, as a read-only memory-mapped numpy array
+    """
+    return np.load(filepath, mmap_mode='r')
+
+
+class ImageStore:
+    """
+    Store of images decoded on demand.
+    An image is identified by its handle, which is either the image itself or the path of its file. Images given
+    directly are simply returned; files are loaded the first time they're requested, then kept in a LRU cache whose
+    size is bounded by a budget of bytes. When the budget is exceeded, the least recently used images are dropped
+    and decoded again if they're requested later.
+    Raw image files (".npy") are memory-mapped instead of being decoded: they don't count against the budget, since
+    their pages are managed by the operating system.
+    """
+
+    def __init__(self, loader, budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        """
+        Constructor.
+        :param loader: The function loading an image from the path of its file
+        :param budget_bytes: The maximum number of bytes of decoded images kept in memory
+        """
+        if budget_bytes < 0:
+            raise Exception(f"Illegal memory budget: {budget_bytes}. Please use a non-negative value.")
+        self.__loader = loader
+        self.__budget = budget_bytes
+        self.__cache = OrderedDict()
+        self.__mapped = {}
+        self.__resident = 0
+
+    @property
+    def budget(self) -> int:
+        return self.__budget
+
+    @property
+    def resident_bytes(self) -> int:
+        """
+        The bytes of decoded images currently kept in memory.
+        """
+        return self.__resident
+
+    def __len__(self) -> int:
+        return len(self.__cache) + len(self.__mapped)
+
+    def get(self, handle) -> np.ndarray:
+        """
+        Returns an image, loading it if it's not in memory.
+        :param handle: The image itself, or the path of its file
+        :return: The image, as a numpy array
+        """
+        if isinstance(handle, np.ndarray):
+            return handle
+        if handle in self.__mapped:
+            return self.__mapped[handle]
+        img = self.__cache.get(handle)
+        if img is not None:
+            self.__cache.move_to_end(handle)
+            return img
+
+        if handle.endswith(RAW_IMAGE_EXTENSION):
+            img = load_raw_image(handle)
+            self.__mapped[handle] = img
+            return img
+        INSTRUMENTATION.count("images_decoded")
+        img = self.__loader(handle)
+        self.__cache[handle] = img
+        self.__resident += img.nbytes
+        self.__evict()
+        INSTRUMENTATION.gauge("image_bytes_held", self.__resident)
+        return img
+
+    def __evict(self) -> None:
+        """
+        Drops the least recently used images until the budget is respected.
+        The most recent image is always kept, even if it exceeds the budget by itself.
+        """
+        while self.__resident > self.__budget and len(self.__cache) > 1:
+            (_, img) = self.__cache.popitem(last=False)
+            self.__resident -= img.nbytes
+            INSTRUMENTATION.count("images_evicted")
+
+    def clear(self) -> None:
+        self.__cache.clear()
+        self.__mapped.clear()
+        self.__resident = 0
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Setting this environment variable to "1" enables the instrumentation from the start
+ENABLE_ENV_VARIABLE = "MATCHA_INSTRUMENTATION"
+
+
+class _DisabledStage:
+    """
+    Context manager doing nothing, returned for every stage while the instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+class Instrumentation:
+    """
+    Collector of performance data about the pipeline.
+    It records:
+    - The wall-clock time spent in every stage, along with the number of times the stage ran.
+    - Counters of the interesting events (e.g. the distances evaluated or the tiles resized).
+    - Gauges, i.e. the last observed value of some quantity (e.g. the bytes of images held in memory).
+    Hooks can be registered to be notified every time a stage ends.
+    While disabled, every method returns immediately, so the calls can be left in the code.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.__enabled = enabled
+        self.__stages = {}
+        self.__counters = {}
+        self.__gauges = {}
+        self.__hooks = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    def enable(self) -> None:
+        self.__enabled = True
+
+    def disable(self) -> None:
+        self.__enabled = False
+
+    def reset(self) -> None:
+        """
+        Clears all the collected data. The hooks are kept.
+        """
+        self.__stages = {}
+        self.__counters = {}
+        self.__gauges = {}
+
+    def add_hook(self, hook) -> None:
+        """
+        Registers a function to be called at the end of every stage.
+        :param hook: A function accepting the name of the stage and its duration, in seconds
+        """
+        self.__hooks.append(hook)
+
+    def remove_hook(self, hook) -> None:
+        self.__hooks.remove(hook)
+
+    def stage(self, name: str):
+        """
+        Measures the duration of a stage of the pipeline.
+        Usage: "with INSTRUMENTATION.stage('name'): ..."
+        :param name: The name of the stage
+        :return: The context manager delimiting the stage
+        """
+        if not self.__enabled:
+            return _DISABLED_STAGE
+        return self.__timed_stage(name)
+
+    @contextmanager
+    def __timed_stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            (count, total) = self.__stages.get(name, (0, 0.0))
+            self.__stages[name] = (count + 1, total + elapsed)
+            for hook in self.__hooks:
+                hook(name, elapsed)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """
+        Increments a counter.
+        :param name: The name of the counter
+        :param amount: The increment
+        """
+        if self.__enabled:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def gauge(self, name: str, value) -> None:
+        """
+        Records the current value of a quantity.
+        :param name: The name of the quantity
+        :param value: The value
+        """
+        if self.__enabled:
+            self.__gauges[name] = value
+
+    def get_stage_seconds(self, name: str) -> float:
+        return self.__stages.get(name, (0, 0.0))[1]
+
+    def get_counter(self, name: str) -> int:
+        return self.__counters.get(name, 0)
+
+    def snapshot(self) -> dict:
+        """
+        Collects all the data recorded so far.
+        :return: A dictionary with the stages (calls and seconds), the counters and the gauges
+        """
+        return {
+            "stages": {name: {"calls": count, "seconds": total} for (name, (count, total)) in self.__stages.items()},
+            "counters": dict(self.__counters),
+            "gauges": dict(self.__gauges),
+        }
+
+    def to_json(self, indent: int = 2) -> str:
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, mode='w') as file:
+            file.write(self.to_json())
+
+
+# Instrumentation shared by the whole pipeline
+INSTRUMENTATION = Instrumentation(enabled=os.environ.get(ENABLE_ENV_VARIABLE) == "1")
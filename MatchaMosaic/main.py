@@ -1,4 +1,5 @@
 from coordinates import Coordinator, AverageSamplerOperator
+from instrumentation import INSTRUMENTATION
 from tiles import TileFactory
 from mosaic import Mosaic
 from math import sqrt
@@ -50,3 +51,7 @@ if __name__ == '__main__':
     #     print(f"Cell in position {cell.position} : {cell.assigned_tile.name}")
 
     mos.show_preview()
+
+    # Enabled with the environment variable MATCHA_INSTRUMENTATION=1
+    if INSTRUMENTATION.enabled:
+        print(INSTRUMENTATION.to_json())
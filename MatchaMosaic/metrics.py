@@ -0,0 +1,259 @@
+"""
+Distance metrics between the coordinates of the cells and the ones of the tiles.
+A metric works on whole matrices: it compares a (C, d) block of cells coordinates with a (T, d) block of tiles
+coordinates in one call, so that a custom similarity runs at NumPy speed instead of one Python call per pair.
+The metrics are found by name in a registry, where new ones can be added:
+
+    class ChebyshevMetric(Metric):
+        def pairwise(self, cells_coords, tiles_coords):
+            return np.abs(cells_coords[:, np.newaxis, :] - tiles_coords[np.newaxis, :, :]).max(axis=2)
+
+    register_metric("chebyshev", ChebyshevMetric)
+    mosaic = Mosaic(target, coordinator, tiles, metric="chebyshev")
+
+The metrics are sent to the worker processes along with the coordinates, so they have to be picklable.
+"""
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from coordinates import COLOR_SPACE_LAB, Coordinator
+from distances import DISTANCE_DTYPE, euclidean_distance_matrix
+
+METRIC_EUCLIDEAN = "euclidean"
+METRIC_MANHATTAN = "manhattan"
+METRIC_COSINE = "cosine"
+METRIC_DELTA_E = "delta_e"
+DEFAULT_METRIC = METRIC_EUCLIDEAN
+# Lower bound of the norms of the vectors compared by the cosine metric
+ZERO_NORM = 1e-12
+
+
+class Metric(ABC):
+    """
+    Abstract distance between coordinates vectors.
+    """
+
+    # Whether the metric is the euclidean distance between the coordinates, which the spatial indexes rely on
+    euclidean = False
+    # The color space the coordinates have to be computed in, for the metrics that only make sense in one of them
+    color_space = None
+
+    @abstractmethod
+    def pairwise(self, cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+        """
+        Computes the distance between every cell and every tile.
+        :param cells_coords: The (C, d) matrix of the cells coordinates
+        :param tiles_coords: The (T, d) matrix of the tiles coordinates
+        :return: The (C, T) matrix of distances
+        """
+        pass
+
+    def paired(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """
+        Computes the distance between every row of a matrix and the same row of another one.
+        Metrics that can work on the rows at once should override this method; the default implementation calls
+        "pairwise" on every pair of rows.
+        :param a: The (N, d) matrix of the first coordinates
+        :param b: The (N, d) matrix of the second coordinates
+        :return: The N distances
+        """
+        return np.array([self.pairwise(a[i:i + 1], b[i:i + 1])[0, 0] for i in range(a.shape[0])],
+                        dtype=DISTANCE_DTYPE)
+
+
+def _check_weights(weights) -> np.ndarray:
+    if weights is None:
+        return None
+    weights = np.asarray(weights, dtype=DISTANCE_DTYPE)
+    if np.any(weights < 0):
+        raise Exception("The weights of a metric cannot be negative")
+    return weights
+
+
+class EuclideanMetric(Metric):
+    """
+    Euclidean distance, optionally weighting every coordinate.
+    The weighted distance is the euclidean distance of the coordinates scaled by the square root of the weights, so it
+    keeps the single matrix product of the plain one.
+    """
+
+    def __init__(self, weights: np.ndarray = None):
+        """
+        Constructor.
+        :param weights: The weight of every coordinate (or a single weight for all of them); none by default
+        """
+        self.__weights = _check_weights(weights)
+        self.__scale = np.sqrt(self.__weights) if self.__weights is not None else None
+
+    @property
+    def euclidean(self) -> bool:
+        return self.__weights is None
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self.__weights
+
+    def pairwise(self, cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+        if self.__scale is not None:
+            (cells_coords, tiles_coords) = (cells_coords * self.__scale, tiles_coords * self.__scale)
+        return euclidean_distance_matrix(cells_coords, tiles_coords)
+
+    def paired(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        difference = a - b
+        if self.__scale is not None:
+            difference *= self.__scale
+        return np.linalg.norm(difference, axis=1).astype(DISTANCE_DTYPE, copy=False)
+
+
+class ManhattanMetric(Metric):
+    """
+    Manhattan (L1) distance, optionally weighting every coordinate.
+    The differences are accumulated one coordinate at a time, so that only the (C, T) matrix of distances is
+    allocated, and not the (C, T, d) tensor of the differences.
+    """
+
+    def __init__(self, weights: np.ndarray = None):
+        """
+        Constructor.
+        :param weights: The weight of every coordinate (or a single weight for all of them); none by default
+        """
+        self.__weights = _check_weights(weights)
+
+    @property
+    def weights(self) -> np.ndarray:
+        return self.__weights
+
+    def pairwise(self, cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+        a = np.asarray(cells_coords, dtype=DISTANCE_DTYPE)
+        b = np.asarray(tiles_coords, dtype=DISTANCE_DTYPE)
+        weights = np.broadcast_to(self.__weights if self.__weights is not None else 1, a.shape[1:])
+        distances = np.zeros(shape=(a.shape[0], b.shape[0]), dtype=DISTANCE_DTYPE)
+        block = np.empty_like(distances)
+        for j in range(a.shape[1]):
+            np.subtract(a[:, j, np.newaxis], b[np.newaxis, :, j], out=block)
+            np.abs(block, out=block)
+            if weights[j] != 1:
+                block *= weights[j]
+            distances += block
+        return distances
+
+    def paired(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        difference = np.abs(a - b)
+        if self.__weights is not None:
+            difference *= self.__weights
+        return difference.sum(axis=1).astype(DISTANCE_DTYPE, copy=False)
+
+
+class CosineMetric(Metric):
+    """
+    Cosine distance: one minus the cosine of the angle between the coordinates vectors.
+    It ignores the length of the vectors, so it matches the hue of the colors more than their brightness. A null
+    vector is orthogonal to every other one.
+    """
+
+    @staticmethod
+    def __normalize(coords: np.ndarray) -> np.ndarray:
+        coords = np.asarray(coords, dtype=DISTANCE_DTYPE)
+        norms = np.linalg.norm(coords, axis=1, keepdims=True)
+        return coords / np.maximum(norms, ZERO_NORM)
+
+    def pairwise(self, cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+        distances = self.__normalize(cells_coords) @ self.__normalize(tiles_coords).T
+        np.subtract(1, distances, out=distances)
+        # Rounding errors can produce tiny negative values
+        return np.maximum(distances, 0, out=distances)
+
+    def paired(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        similarities = np.einsum("ij,ij->i", self.__normalize(a), self.__normalize(b))
+        return np.maximum(1 - similarities, 0)
+
+
+class DeltaEMetric(EuclideanMetric):
+    """
+    Perceptual color difference CIE76 (delta E*ab): the euclidean distance between colors in the CIELAB space.
+    The metric itself doesn't convert anything: the coordinates have to be computed in the CIELAB space by the
+    operators (see AverageSamplerOperator and its "color_space"), so that every color is converted once when the
+    features are extracted, and not at every comparison.
+    """
+
+    color_space = COLOR_SPACE_LAB
+
+
+class FunctionMetric(Metric):
+    """
+    Metric defined by a function working on matrices, for the users who don't need a class.
+    """
+
+    def __init__(self, function, paired=None):
+        """
+        Constructor.
+        :param function: The function computing the (C, T) matrix of distances from the (C, d) and (T, d) matrices
+        :param paired: An optional function computing the N distances between the rows of two (N, d) matrices
+        """
+        if not callable(function):
+            raise Exception("The metric function is not callable")
+        self.__function = function
+        self.__paired = paired
+
+    def pairwise(self, cells_coords: np.ndarray, tiles_coords: np.ndarray) -> np.ndarray:
+        return np.asarray(self.__function(cells_coords, tiles_coords), dtype=DISTANCE_DTYPE)
+
+    def paired(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if self.__paired is None:
+            return super().paired(a, b)
+        return np.asarray(self.__paired(a, b), dtype=DISTANCE_DTYPE)
+
+
+METRICS = {
+    METRIC_EUCLIDEAN: EuclideanMetric,
+    METRIC_MANHATTAN: ManhattanMetric,
+    METRIC_COSINE: CosineMetric,
+    METRIC_DELTA_E: DeltaEMetric,
+}
+
+
+def register_metric(name: str, factory) -> None:
+    """
+    Adds a metric to the registry, so that it can be selected by name.
+    :param name: The name of the metric
+    :param factory: The Metric subclass, or any function building the metric without arguments
+    """
+    if not name:
+        raise Exception("Cannot register a metric without a name")
+    METRICS[name] = factory
+
+
+def check_color_space(metric: Metric, coordinator: Coordinator) -> None:
+    """
+    Checks that the coordinates computed by a coordinator are in the color space required by a metric.
+    :param metric: The metric
+    :param coordinator: The coordinator computing the coordinates of the cells and of the tiles
+    """
+    if metric.color_space is None:
+        return
+    spaces = coordinator.color_spaces
+    if spaces != {metric.color_space}:
+        raise Exception(f"The metric requires the colors in the \"{metric.color_space}\" space, but the operators "
+                        f"of the coordinator use {sorted(spaces) if spaces else 'no color space'}. Please build the "
+                        f"operators with color_space=\"{metric.color_space}\".")
+
+
+def get_metric(metric=None) -> Metric:
+    """
+    Resolves a metric.
+    :param metric: A Metric, the name of a registered metric, or a function computing the matrix of distances;
+    the default metric if None
+    :return: The metric
+    """
+    if metric is None:
+        metric = DEFAULT_METRIC
+    if isinstance(metric, Metric):
+        return metric
+    if isinstance(metric, str):
+        if metric not in METRICS:
+            raise Exception(f"Unknown metric: {metric}. Please use one of {sorted(METRICS)}.")
+        return METRICS[metric]()
+    if callable(metric):
+        return FunctionMetric(metric)
+    raise Exception(f"Illegal metric: {metric}")
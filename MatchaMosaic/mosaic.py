@@ -1,12 +1,21 @@
 import numpy as np
-from cells import Cell
+from assignment import AuctionSolver, GreedyScheduler
+from cells import DEFAULT_CELL_CANDIDATES, NO_TILE, CellGrid
 from coordinates import Coordinator
-from tiles import Tile
+from instrumentation import INSTRUMENTATION
+from metrics import DEFAULT_METRIC, check_color_space, get_metric
+from distances import DISTANCE_DTYPE, candidate_tiles, nearest_tiles, stack_coordinates
+from pruning import CoarseToFineMatcher
+from rendering import TileRenderCache, grid_view
+from tiles import Tile, TileLibrary
 from utilities import show_image, load_image
-import cv2
 
 DEFAULT_GRID_SHAPE = (10, 10)
 DEFAULT_REINSERTION = False
+DEFAULT_WORKERS = 1
+SOLVER_GREEDY = "greedy"
+SOLVER_OPTIMAL = "optimal"
+DEFAULT_SOLVER = SOLVER_GREEDY
 
 
 class Mosaic:
@@ -18,15 +27,55 @@ class Mosaic:
                  coordinator: Coordinator,
                  tiles: [Tile],
                  grid: (int, int) = DEFAULT_GRID_SHAPE,
-                 reinsertion: bool = DEFAULT_REINSERTION):
+                 reinsertion: bool = DEFAULT_REINSERTION,
+                 render_cache: TileRenderCache = None,
+                 index_factory=None,
+                 workers: int = DEFAULT_WORKERS,
+                 use_processes: bool = False,
+                 solver: str = DEFAULT_SOLVER,
+                 auction_solver: AuctionSolver = None,
+                 candidates: int = DEFAULT_CELL_CANDIDATES,
+                 metric=DEFAULT_METRIC,
+                 matcher: CoarseToFineMatcher = None):
+        """
+        Creates the mosaic, dividing the target image into cells and computing their coordinates.
+        :param targetpath: The path of the target image
+        :param coordinator: The coordinator used to compute the coordinates of the cells
+        :param tiles: The available tiles
+        :param grid: The number of rows and columns of cells
+        :param reinsertion: Whether the tiles can be used without limits
+        :param render_cache: An optional cache of the resized tiles, possibly shared with other mosaics
+        :param index_factory: An optional function (or TileIndex subclass) that builds a nearest-neighbour index from
+        the matrix of the tiles coordinates. If given, the cells query the index instead of ranking all the tiles.
+        :param workers: The number of threads (or processes) looking for the nearest tiles when reinsertion is used
+        :param use_processes: Whether the workers are processes sharing the coordinates, instead of threads
+        :param solver: How the tiles are assigned when their quantities are limited: "greedy" gives every time the
+        nearest available tile to the fittest cell, "optimal" minimizes the total distance of the mosaic
+        :param auction_solver: An optional solver used by the "optimal" strategy, to tune its parameters
+        :param candidates: The number of nearest tiles kept for every cell by the greedy strategy; when all of them run
+        out, the nearest available tile is looked for among all the tiles. All the tiles are ranked if it's None.
+        :param metric: The distance between the coordinates of the cells and the ones of the tiles: a Metric, the name
+        of a registered one (see metrics.METRICS) or a function computing the matrix of distances. The indexes only
+        support the euclidean distance; "delta_e" needs the operators of the coordinator in the "lab" color space.
+        :param matcher: An optional coarse-to-fine matcher, which finds the nearest tiles comparing the full
+        coordinates only with a shortlist of tiles; its recall is measured against the exhaustive search
+        """
+        if solver not in (SOLVER_GREEDY, SOLVER_OPTIMAL):
+            raise Exception(f"Unknown solver: {solver}. Please use \"{SOLVER_GREEDY}\" or \"{SOLVER_OPTIMAL}\".")
+
+        self.__metric = get_metric(metric)
+        if index_factory is not None and not self.__metric.euclidean:
+            raise Exception("The nearest-neighbour indexes only support the euclidean distance")
 
         if not targetpath:
             raise Exception("Cannot create a mosaic without the target image")
-        self.__original = load_image(targetpath)
+        with INSTRUMENTATION.stage("target_loading"):
+            self.__original = load_image(targetpath)
 
         if not coordinator:
             raise Exception("Cannot create a mosaic without specifying how to extract coordinates")
         self.__coordinator = coordinator
+        check_color_space(self.__metric, coordinator)
 
         if not tiles or len(tiles) == 0:
             raise Exception("Cannot create a mosaic without a tiles list")
@@ -36,23 +85,67 @@ class Mosaic:
         cell_w = int(self.original.shape[1] / grid[1])
         print(f"Set cells with dimension: vertical = {cell_h}, horizontal = {cell_w}")
         self.__scale = (cell_h, cell_w)
-        self.cells = []
-        for i in range(grid[0]):
-            for j in range(grid[1]):
-                self.cells.append(
-                    Cell(
-                        (i, j),
-                        self.original[
-                            slice(i * cell_h, (i + 1) * cell_h),
-                            slice(j * cell_w, (j + 1) * cell_w),
-                            :
-                        ],
-                        self.__coordinator,
-                        tiles
-                    )
-                )
+        # Computing the coordinates of every cell
+        with INSTRUMENTATION.stage("target_featurization"):
+            cells_coords = self.__coordinator.compute_grid(self.original, grid).astype(DISTANCE_DTYPE)
 
         self.__reinsertion = reinsertion
+        self.__workers = workers
+        self.__use_processes = use_processes
+        # The optimal strategy only makes sense when the quantities are limited
+        self.__optimal = solver == SOLVER_OPTIMAL and not reinsertion
+        self.__auction_solver = auction_solver if auction_solver is not None else AuctionSolver()
+        self.__tiles = tiles
+        self.__candidates = candidates
+        self.__matcher = matcher
+        with INSTRUMENTATION.stage("cell_construction"):
+            self.__create_cells(cells_coords, tiles, index_factory)
+
+        # The cache can be shared by many mosaics using the same tiles
+        self.__render_cache = render_cache if render_cache is not None else TileRenderCache()
+
+    def __create_cells(self, cells_coords: np.ndarray, tiles: [Tile], index_factory) -> None:
+        """
+        Creates the grid of cells, finding the nearest tiles of all of them at once.
+        """
+        tiles_coords = self.__tiles_coords(tiles)
+        if index_factory is not None:
+            # Looking for the nearest tile of all the cells through the index
+            index = index_factory(tiles_coords)
+            (nearest, nearest_dist) = index.query_batch(cells_coords)
+            self.__cells = CellGrid(self.__grid, cells_coords, tiles, index=index, metric=self.__metric)
+            self.__cells.set_nearest(nearest, nearest_dist)
+        elif self.__reinsertion:
+            # The quantities never change: every cell only needs its nearest tile
+            if self.__matcher is not None:
+                (nearest, nearest_dist) = self.__matcher.nearest_tiles(cells_coords, tiles_coords, metric=self.__metric)
+            else:
+                (nearest, nearest_dist) = nearest_tiles(cells_coords, tiles_coords, workers=self.__workers,
+                                                        use_processes=self.__use_processes, metric=self.__metric)
+            self.__cells = CellGrid(self.__grid, cells_coords, tiles, nearest[:, np.newaxis],
+                                    nearest_dist[:, np.newaxis], metric=self.__metric)
+        else:
+            # Ranking the nearest tiles for all the cells at once
+            k = self.__candidates if self.__candidates is not None else len(tiles)
+            if self.__optimal:
+                # The cells keep the candidates graph of the auction, which is solved on it without searching again
+                k = min(self.__auction_solver.candidates, len(tiles))
+            search = self.__matcher.candidate_tiles if self.__matcher is not None else candidate_tiles
+            (candidates, distances) = search(cells_coords, tiles_coords, k, metric=self.__metric)
+            self.__cells = CellGrid(self.__grid, cells_coords, tiles, candidates, distances, metric=self.__metric)
+
+    @property
+    def cells(self) -> CellGrid:
+        """
+        The cells of the mosaic: iterating over the grid gives a view of every cell, in row-major order.
+        """
+        return self.__cells
+
+    @staticmethod
+    def __tiles_coords(tiles: [Tile]) -> np.ndarray:
+        if isinstance(tiles, TileLibrary):
+            return tiles.coords
+        return stack_coordinates([t.coords for t in tiles])
 
     def assign_tiles(self) -> None:
         """
@@ -61,43 +154,90 @@ class Mosaic:
         The strategy for the assignment can vary; the default one assignes the cell
         with the minimum distance to a tile, based on the coordinates computation.
         """
-        unassigned_cells: [Cell] = self.cells.copy()
-        # print("To-Be-Assigned cells list:")
-        # for c in unassigned_cells:
-        #     print(f" -> {c.position}")
-
-        # Assigning all the cells to a tile
-        while len(unassigned_cells) > 0:
-            # print(f"{len(unassigned_cells)} unassigned cells left")
-            # Sorting the cells depending on the distance
-            unassigned_cells.sort(key=Cell.get_nearest_distance)
-            # Extracting the fittest cell
-            cell = unassigned_cells.pop(0)
-            # The cell with the minimum distance get assigned
-            # The usage of the tile is registered (decrease_availability = True)
-            # iff the reinsertion is not used (self.__reinsertion = False)
-            cell.assign_tile(decrease_availability=not self.__reinsertion)
-            # print(f"Assigned cell {cell.position} to tile : {cell.assigned_tile.name}")
+        with INSTRUMENTATION.stage("assign_tiles"):
+            if self.__reinsertion:
+                # Without limits on the quantities, every cell simply gets its nearest tile
+                self.__cells.assign_all(self.__cells.nearest_indices(), decrease_availability=False)
+                return
+            if self.__optimal:
+                self.__assign_optimal()
+                return
+
+            scheduler = GreedyScheduler(self.cells)
+
+            # Assigning all the cells to a tile
+            while len(scheduler) > 0:
+                # Extracting the fittest cell
+                cell = scheduler.pop_fittest()
+                # The cell with the minimum distance get assigned
+                # The usage of the tile is registered (decrease_availability = True)
+                # iff the reinsertion is not used (self.__reinsertion = False)
+                cell.assign_tile(decrease_availability=not self.__reinsertion)
+
+    def __assign_optimal(self) -> None:
+        """
+        Assigns the tiles minimizing the total distance between the cells and their tiles.
+        """
+        (tiles, cells) = (self.__tiles, self.__cells)
+        if isinstance(tiles, TileLibrary):
+            quantities = tiles.quantities
+        else:
+            quantities = np.array([t.quantity for t in tiles], dtype=np.int64)
+        # The cells built on an index have no candidates: the solver finds its own
+        candidate_graph = (cells.candidates, cells.candidate_distances) if cells.candidates is not None else None
+        (assignment, total) = self.__auction_solver.solve(cells.coords, self.__tiles_coords(tiles), quantities,
+                                                          metric=self.__metric, matcher=self.__matcher,
+                                                          candidate_graph=candidate_graph)
+        INSTRUMENTATION.gauge("assignment_cost", total)
+        cells.assign_all(assignment)
+
+    def get_total_cost(self) -> float:
+        """
+        The sum of the distances between every cell and its assigned tile, to compare the assignment strategies.
+        :return: The total distance
+        """
+        cells = self.__cells
+        if np.any(cells.assigned == NO_TILE):
+            raise Exception("Cannot compute the total cost: some cells have no tile assigned")
+        assigned_coords = self.__tiles_coords(self.__tiles)[cells.assigned]
+        return float(self.__metric.paired(cells.coords, assigned_coords).sum())
 
     @property
     def original(self):
         return self.__original
 
+    def render(self, output: np.ndarray = None) -> np.ndarray:
+        """
+        Draws the mosaic, placing the image of the assigned tile over every cell.
+        The cells are grouped by tile, so that every tile is resized once and copied over all its cells at once.
+        :param output: An optional image (with 3 channels) where the mosaic is drawn; it must be at least as large as
+        the area covered by the cells. If not given, a black image with the size of the original is created.
+        :return: The image of the mosaic
+        """
+        with INSTRUMENTATION.stage("render"):
+            return self.__render(output)
+
+    def __render(self, output: np.ndarray) -> np.ndarray:
+        if output is None:
+            (height, width) = (self.original.shape[0], self.original.shape[1])
+            output = np.zeros(shape=(height, width, 3), dtype=np.uint8)
+        view = grid_view(output, self.__grid, self.__scale)
+
+        assigned = self.__cells.assigned
+        missing = np.flatnonzero(assigned == NO_TILE)
+        if len(missing) > 0:
+            raise Exception(f"Cannot render the mosaic: the cell {self.__cells.position(missing[0])} has no tile "
+                            f"assigned")
+
+        # Grouping the cells by assigned tile
+        for tile_index in np.unique(assigned):
+            (rows, cols) = np.divmod(np.flatnonzero(assigned == tile_index), self.__grid[1])
+            view[rows, :, cols, :] = self.__render_cache.get(self.__tiles[int(tile_index)], self.__scale)
+
+        return output
+
     def get_preview(self) -> []:
-        (height, width) = (self.original.shape[0], self.original.shape[1])
-        mosaic = np.zeros(shape=(height, width, 3), dtype=np.uint8)
-        for cell in self.cells:
-            (i, j) = cell.position
-            # print(f"i = {i}, j = {j}")
-            # print(f'Tile "{cell.assigned_tile.name}" has shape = {cell.assigned_tile.image.shape}')
-            res_tile = cv2.resize(cell.assigned_tile.image, dsize=(self.__scale[1], self.__scale[0]), interpolation=cv2.INTER_CUBIC)
-            # print(f'Tile image has been resized to shape = {res_tile.shape}, equal to scale = {self.__scale}')
-            verti_slice = slice(i * self.__scale[0], (i + 1) * self.__scale[0])
-            horiz_slice = slice(j * self.__scale[1], (j + 1) * self.__scale[1])
-            # print(f'Vertical slice = {verti_slice}, horizontal slice = {horiz_slice}')
-            mosaic[verti_slice, horiz_slice] = res_tile
-
-        return mosaic
+        return self.render()
 
     def show_preview(self) -> None:
         show_image(self.get_preview())
@@ -0,0 +1,243 @@
+"""
+Coarse-to-fine matching: the nearest tiles are found in two stages, to avoid comparing the full coordinates of every
+cell with every tile when the operators produce long vectors (e.g. an 8x8 sampler plus a 1x1 one).
+First the coordinates are projected to a few dimensions, and the distances in the projected space shortlist the most
+promising tiles of every cell. Then the exact distances, with the metric of the mosaic, are computed only for the
+shortlisted tiles, and the nearest ones are picked among them.
+The projection is either the principal components of the tiles coordinates, or a block of columns chosen by the user
+(e.g. the coordinates of the 1x1 operator, see Coordinator.get_slices). The result is approximate: its accuracy is
+tuned by the size of the shortlist, and it's measured on a sample of cells against the exhaustive search.
+
+Usage:
+    matcher = CoarseToFineMatcher(shortlist=32, components=8)
+    mosaic = Mosaic(target, coordinator, tiles, matcher=matcher)
+    print(matcher.recall)
+"""
+import numpy as np
+
+from distances import DEFAULT_CHUNK_SIZE, DISTANCE_DTYPE, candidate_tiles, rank_tiles
+from instrumentation import INSTRUMENTATION
+from metrics import Metric, get_metric
+
+DEFAULT_SHORTLIST = 64
+DEFAULT_COMPONENTS = 8
+DEFAULT_RECALL_SAMPLE = 256
+# Upper bound of the coordinates gathered at once for the exact distances, to bound the memory
+EXACT_BLOCK_ELEMENTS = 1 << 22
+# Relative tolerance of the distances, when the approximate candidates are compared with the exact ones
+RECALL_TOLERANCE = 1e-5
+
+
+class CoarseToFineMatcher:
+    """
+    Two-stage search of the nearest tiles of every cell.
+    The shortlist has a fixed size, or it's doubled until the recall measured on a sample of cells reaches a target.
+    The recall is the fraction of the real k nearest tiles found by the matcher: a found tile counts as correct if its
+    distance is not larger than the one of the k-th real nearest tile, so that ties don't count as misses.
+    """
+
+    def __init__(self, shortlist: int = DEFAULT_SHORTLIST, components: int = DEFAULT_COMPONENTS, columns=None,
+                 target_recall: float = None, recall_sample: int = DEFAULT_RECALL_SAMPLE,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, seed: int = 0):
+        """
+        Constructor.
+        :param shortlist: The number of tiles shortlisted for every cell by the coarse stage; the search is exhaustive
+        when it's not smaller than the number of tiles
+        :param components: The number of principal components of the projection
+        :param columns: The columns of the coordinates used by the coarse stage (a slice or a list of indices), instead
+        of the principal components
+        :param target_recall: The minimum recall; if given, the shortlist is doubled until the recall measured on the
+        sample reaches it
+        :param recall_sample: The number of cells used to measure the recall; 0 disables the measure, unless a target
+        is given
+        :param chunk_size: The number of cells processed together
+        :param seed: The seed of the choice of the sampled cells
+        """
+        if shortlist < 1:
+            raise Exception(f"Illegal shortlist size: {shortlist}. Please use a positive value.")
+        if columns is None and components < 1:
+            raise Exception(f"Illegal number of components: {components}. Please use a positive value.")
+        if target_recall is not None and not 0 < target_recall <= 1:
+            raise Exception(f"Illegal target recall: {target_recall}. Please use a value in (0, 1].")
+        if recall_sample < 0 or (target_recall is not None and recall_sample == 0):
+            raise Exception(f"Illegal recall sample: {recall_sample}. Please use a positive value.")
+        if chunk_size < 1:
+            raise Exception(f"Illegal chunk size: {chunk_size}. Please use a positive value.")
+        self.__shortlist = shortlist
+        self.__components = components
+        self.__columns = columns
+        self.__target_recall = target_recall
+        self.__recall_sample = recall_sample
+        self.__chunk_size = chunk_size
+        self.__seed = seed
+        # Results of the last search
+        self.recall = None
+        self.shortlist_used = None
+
+    def fit(self, tiles_coords: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Computes the projection of the coarse stage.
+        The principal components are the eigenvectors of the covariance of the tiles coordinates: the covariance is a
+        (d, d) matrix, so the cost grows only linearly with the number of tiles.
+        :param tiles_coords: The (T, d) matrix of the tiles coordinates
+        :return: The center and the (d, r) matrix of the projection
+        """
+        d = tiles_coords.shape[1]
+        if self.__columns is not None:
+            selected = np.arange(d)[self.__columns]
+            projection = np.zeros(shape=(d, len(selected)))
+            projection[selected, np.arange(len(selected))] = 1
+            return np.zeros(shape=d), projection
+        center = tiles_coords.mean(axis=0, dtype=np.float64)
+        centered = tiles_coords - center
+        covariance = centered.T @ centered
+        # The eigenvalues are ascending: the last vectors are the principal ones
+        (_, vectors) = np.linalg.eigh(covariance)
+        r = min(self.__components, d)
+        return center, vectors[:, ::-1][:, :r]
+
+    def candidate_tiles(self, cells_coords: np.ndarray, tiles_coords: np.ndarray, k: int,
+                        metric: Metric = None) -> (np.ndarray, np.ndarray):
+        """
+        Finds the k nearest tiles of every cell, with the same interface of distances.candidate_tiles.
+        :param cells_coords: The (C, d) matrix of the cells coordinates
+        :param tiles_coords: The (T, d) matrix of the tiles coordinates
+        :param k: The number of candidates of every cell
+        :param metric: The metric of the exact distances; the euclidean one if not given
+        :return: The (C, k) matrix of the candidate tiles, ordered by increasing distance, and the matrix of their
+        exact distances
+        """
+        metric = get_metric(metric)
+        n_tiles = tiles_coords.shape[0]
+        k = min(k, n_tiles)
+        shortlist = max(self.__shortlist, k)
+        (center, projection) = self.fit(tiles_coords)
+        projected_tiles = ((tiles_coords - center) @ projection).astype(DISTANCE_DTYPE)
+
+        # The exhaustive search on a sample of cells is the reference of the recall
+        sample = self.__sample(cells_coords.shape[0])
+        exact = None
+        if len(sample) > 0 and shortlist < n_tiles:
+            exact = candidate_tiles(cells_coords[sample], tiles_coords, k, metric=metric)
+        if self.__target_recall is not None:
+            # Growing the shortlist on the sample, until it's accurate enough
+            while shortlist < n_tiles:
+                found = self.__search(cells_coords[sample], tiles_coords, projected_tiles, center, projection, k,
+                                      shortlist, metric)
+                if self.__recall(found, exact) >= self.__target_recall:
+                    break
+                shortlist = min(2 * shortlist, n_tiles)
+
+        if shortlist >= n_tiles:
+            # The shortlist would include every tile
+            result = candidate_tiles(cells_coords, tiles_coords, k, chunk_size=self.__chunk_size, metric=metric)
+            self.recall = 1.0
+        else:
+            result = self.__search(cells_coords, tiles_coords, projected_tiles, center, projection, k, shortlist,
+                                   metric)
+            self.recall = self.__recall((result[0][sample], result[1][sample]), exact) if exact is not None else None
+        self.shortlist_used = min(shortlist, n_tiles)
+        INSTRUMENTATION.gauge("coarse_shortlist", self.shortlist_used)
+        if self.recall is not None:
+            INSTRUMENTATION.gauge("coarse_recall", self.recall)
+        return result
+
+    def nearest_tiles(self, cells_coords: np.ndarray, tiles_coords: np.ndarray,
+                      metric: Metric = None) -> (np.ndarray, np.ndarray):
+        """
+        Finds the nearest tile of every cell, with the same interface of distances.nearest_tiles.
+        :return: The array of the indices of the nearest tiles and the array of their exact distances
+        """
+        (candidates, distances) = self.candidate_tiles(cells_coords, tiles_coords, 1, metric=metric)
+        return candidates[:, 0], distances[:, 0]
+
+    def __sample(self, n_cells: int) -> np.ndarray:
+        size = min(self.__recall_sample, n_cells)
+        rng = np.random.default_rng(self.__seed)
+        return np.sort(rng.choice(n_cells, size=size, replace=False))
+
+    def __search(self, cells_coords: np.ndarray, tiles_coords: np.ndarray, projected_tiles: np.ndarray,
+                 center: np.ndarray, projection: np.ndarray, k: int, shortlist: int,
+                 metric: Metric) -> (np.ndarray, np.ndarray):
+        """
+        Runs the two stages on all the given cells, one chunk at a time.
+        """
+        (n_cells, d) = cells_coords.shape
+        candidates = np.empty(shape=(n_cells, k), dtype=np.intp)
+        distances = np.empty(shape=(n_cells, k), dtype=DISTANCE_DTYPE)
+        # The exact stage gathers the coordinates of the shortlisted tiles of a few cells at a time
+        exact_rows = max(1, EXACT_BLOCK_ELEMENTS // (shortlist * d))
+        # The coarse ranking of a cell only needs ||b||^2 - 2ab: the norm of the cell is the same for all the tiles
+        projected_sq_norms = np.einsum("ij,ij->i", projected_tiles, projected_tiles)
+        if metric.euclidean:
+            # As in the exhaustive search, the coordinates are centered on the mean of the tiles to reduce the
+            # cancellation error of the expanded distances
+            offset = tiles_coords.mean(axis=0)
+            tiles_coords = (tiles_coords - offset).astype(DISTANCE_DTYPE, copy=False)
+            tiles_sq_norms = np.einsum("ij,ij->i", tiles_coords, tiles_coords)
+        else:
+            (offset, tiles_sq_norms) = (None, None)
+        for start in range(0, n_cells, self.__chunk_size):
+            cells = cells_coords[start:start + self.__chunk_size]
+            # Coarse stage: the projected distances select the shortlist, in no particular order
+            projected_cells = (-2 * ((cells - center) @ projection)).astype(DISTANCE_DTYPE)
+            if offset is not None:
+                cells = (cells - offset).astype(DISTANCE_DTYPE, copy=False)
+            INSTRUMENTATION.count("coarse_distances_evaluated", cells.shape[0] * projected_tiles.shape[0])
+            coarse = projected_cells @ projected_tiles.T
+            coarse += projected_sq_norms
+            short = np.argpartition(coarse, shortlist - 1, axis=1)[:, :shortlist]
+            # Sorting by index, so that the ties of the exact distances are broken as in the exhaustive search
+            short.sort(axis=1)
+
+            # Exact stage, on the shortlisted tiles only
+            exact = np.empty(shape=short.shape, dtype=DISTANCE_DTYPE)
+            for first in range(0, cells.shape[0], exact_rows):
+                rows = slice(first, first + exact_rows)
+                exact[rows] = self.__exact_distances(cells[rows], tiles_coords, tiles_sq_norms, short[rows], metric)
+            INSTRUMENTATION.count("distances_evaluated", short.size)
+
+            ranking = rank_tiles(exact, k)
+            candidates[start:start + self.__chunk_size] = np.take_along_axis(short, ranking, axis=1)
+            distances[start:start + self.__chunk_size] = np.take_along_axis(exact, ranking, axis=1)
+        return candidates, distances
+
+    @staticmethod
+    def __exact_distances(cells_coords: np.ndarray, tiles_coords: np.ndarray, tiles_sq_norms: np.ndarray,
+                          shortlists: np.ndarray, metric: Metric) -> np.ndarray:
+        """
+        Computes the distances between every cell and its shortlisted tiles.
+        :param cells_coords: The (N, d) matrix of the cells coordinates
+        :param tiles_coords: The (T, d) matrix of the tiles coordinates, centered for the euclidean distance
+        :param tiles_sq_norms: The squared norms of the tiles coordinates, for the euclidean distance
+        :param shortlists: The (N, S) matrix of the shortlisted tiles of every cell
+        :return: The (N, S) matrix of distances
+        """
+        shortlisted = np.take(tiles_coords, shortlists, axis=0)
+        if metric.euclidean:
+            # ||a||^2 + ||b||^2 - 2ab, with one matrix-vector product per cell
+            sq_dist = np.matmul(shortlisted, cells_coords[:, :, np.newaxis])[:, :, 0]
+            sq_dist *= -2
+            sq_dist += np.einsum("ij,ij->i", cells_coords, cells_coords)[:, np.newaxis]
+            sq_dist += tiles_sq_norms[shortlists]
+            # Rounding errors can produce tiny negative values
+            np.maximum(sq_dist, 0, out=sq_dist)
+            return np.sqrt(sq_dist, out=sq_dist)
+        pairs = np.repeat(cells_coords, shortlists.shape[1], axis=0)
+        return metric.paired(pairs, shortlisted.reshape(-1, tiles_coords.shape[1])).reshape(shortlists.shape)
+
+    @staticmethod
+    def __recall(found: (np.ndarray, np.ndarray), exact: (np.ndarray, np.ndarray)) -> float:
+        """
+        The fraction of the real nearest tiles found by the matcher.
+        :param found: The candidates of the matcher, with their distances
+        :param exact: The candidates of the exhaustive search, with their distances
+        :return: The recall
+        """
+        (_, found_distances) = found
+        (_, exact_distances) = exact
+        if found_distances.size == 0:
+            return 1.0
+        # The distance of the k-th real nearest tile of every cell
+        bound = exact_distances[:, -1:] * (1 + RECALL_TOLERANCE) + RECALL_TOLERANCE
+        return float(np.mean(found_distances <= bound))
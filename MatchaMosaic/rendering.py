@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from imagestore import DEFAULT_BUDGET_BYTES
+from instrumentation import INSTRUMENTATION
+from tiles import Tile
+
+DEFAULT_INTERPOLATION = cv2.INTER_CUBIC
+
+
+class TileRenderCache:
+    """
+    Cache of the resized images of the tiles.
+    Every tile is resized only once for each cell size, no matter how many cells it's assigned to.
+    Tiles loaded from files are identified by their file, so the cache keeps working across copies of a library (e.g.
+    when many mosaics are composed with the same tiles).
+    As in the ImageStore, the resized images are kept in a LRU cache bounded by a budget of bytes: a long-lived cache,
+    serving targets with many different cell sizes, drops the least recently used images instead of growing forever.
+    """
+
+    def __init__(self, interpolation: int = DEFAULT_INTERPOLATION, budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        """
+        Constructor.
+        :param interpolation: The OpenCV interpolation flag used to resize the images
+        :param budget_bytes: The maximum number of bytes of resized images kept in memory
+        """
+        if budget_bytes < 0:
+            raise Exception(f"Illegal memory budget: {budget_bytes}. Please use a non-negative value.")
+        self.__interpolation = interpolation
+        self.__budget = budget_bytes
+        self.__resized = OrderedDict()
+        self.__resident = 0
+
+    def __len__(self) -> int:
+        return len(self.__resized)
+
+    @property
+    def budget(self) -> int:
+        return self.__budget
+
+    @property
+    def resident_bytes(self) -> int:
+        """
+        The bytes of resized images currently kept in memory.
+        """
+        return self.__resident
+
+    def get(self, tile: Tile, size: (int, int)) -> np.ndarray:
+        """
+        Returns the image of a tile, resized to the given size.
+        :param tile: The tile
+        :param size: The height and width of the resized image
+        :return: The resized image
+        """
+        handle = tile.library.get_image_handle(tile.index)
+        key = (handle if isinstance(handle, str) else tile, size)
+        resized = self.__resized.get(key)
+        if resized is not None:
+            self.__resized.move_to_end(key)
+            return resized
+        INSTRUMENTATION.count("resize_calls")
+        resized = cv2.resize(tile.image, dsize=(size[1], size[0]), interpolation=self.__interpolation)
+        self.__resized[key] = resized
+        self.__resident += resized.nbytes
+        self.__evict()
+        return resized
+
+    def __evict(self) -> None:
+        """
+        Drops the least recently used images until the budget is respected.
+        The most recent image is always kept, even if it exceeds the budget by itself.
+        """
+        while self.__resident > self.__budget and len(self.__resized) > 1:
+            (_, resized) = self.__resized.popitem(last=False)
+            self.__resident -= resized.nbytes
+            INSTRUMENTATION.count("resized_evicted")
+
+    def clear(self) -> None:
+        self.__resized.clear()
+        self.__resident = 0
+
+
+def grid_view(output: np.ndarray, grid: (int, int), cell_shape: (int, int)) -> np.ndarray:
+    """
+    Returns a view of an image split into cells, with axes (row, cell row, column, cell column, channel).
+    Writing into the view writes into the image; the pixels beyond the last complete cell are not part of it.
+    :param output: The image, as a numpy array with shape (height, width, channels)
+    :param grid: The number of rows and columns of cells
+    :param cell_shape: The height and width of every cell
+    :return: The 5-dimensional view
+    """
+    (cell_h, cell_w) = cell_shape
+    if output.shape[0] < grid[0] * cell_h or output.shape[1] < grid[1] * cell_w:
+        raise Exception(f"The output with shape {output.shape} is too small for {grid} cells of shape {cell_shape}")
+    (stride_h, stride_w, stride_c) = output.strides
+    return np.lib.stride_tricks.as_strided(
+        output,
+        shape=(grid[0], cell_h, grid[1], cell_w, output.shape[2]),
+        strides=(stride_h * cell_h, stride_h, stride_w * cell_w, stride_w, stride_c),
+        writeable=True
+    )
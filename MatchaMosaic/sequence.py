@@ -0,0 +1,244 @@
+"""
+Sequence mode: mosaics of the frames of a video, or of a sequence of images.
+Consecutive frames are usually similar, so every frame starts from the mosaic of the previous one: only the cells whose
+coordinates moved away from the ones they were assigned with are assigned again and redrawn. This cuts the work per
+frame, and it avoids the flicker of cells switching between equivalent tiles from a frame to the next one.
+The frames are read and written one at a time, so the sequence is never held in memory.
+
+Usage:
+    python sequence.py --tiles tiles/tiles_info.csv --input clip.mp4 --output mosaic.mp4 --grid 42x57 --reinsertion
+    python sequence.py --tiles tiles/tiles_info.csv --input frames/ --output mosaic_frames/ --threshold 12
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from arguments import add_library_arguments, load_library
+from assignment import assign_greedily
+from cells import NO_TILE
+from coordinates import Coordinator
+from distances import DISTANCE_DTYPE, nearest_tiles
+from instrumentation import INSTRUMENTATION
+from metrics import DEFAULT_METRIC, check_color_space, get_metric
+from mosaic import DEFAULT_GRID_SHAPE, DEFAULT_REINSERTION
+from rendering import TileRenderCache, grid_view
+from tiles import Tile, TileLibrary
+from utilities import TARGET_EXTENSIONS, list_targets, load_image
+
+DEFAULT_THRESHOLD = 8.0
+DEFAULT_FPS = 25.0
+DEFAULT_FOURCC = "mp4v"
+FRAME_NAME_FORMAT = "frame_{:06d}.png"
+
+
+class MosaicSequence:
+    """
+    Mosaic updated frame after frame.
+    For every cell, the coordinates it was last assigned with are kept along with its tile. When a new frame comes,
+    the coordinates of all the cells are computed at once; the cells that moved further than the threshold give back
+    their tile, and they're assigned again (with the greedy strategy, if the quantities are limited). The other cells
+    keep their tile, and their pixels in the output are not touched.
+    """
+
+    def __init__(self, coordinator: Coordinator, tiles: [Tile], grid: (int, int) = DEFAULT_GRID_SHAPE,
+                 reinsertion: bool = DEFAULT_REINSERTION, threshold: float = DEFAULT_THRESHOLD,
+                 render_cache: TileRenderCache = None, metric=DEFAULT_METRIC):
+        """
+        Constructor.
+        :param coordinator: The coordinator used to compute the coordinates of the cells
+        :param tiles: The available tiles; their quantities are copied, so they're not consumed by the sequence
+        :param grid: The number of rows and columns of cells
+        :param reinsertion: Whether the tiles can be used without limits
+        :param threshold: The distance the coordinates of a cell must move before the cell is assigned again; 0
+        assigns again every cell at every frame
+        :param render_cache: An optional cache of the resized tiles
+        :param metric: The distance between the coordinates (see Mosaic), also used to measure how far a cell moved
+        """
+        if not coordinator:
+            raise Exception("Cannot create a mosaic without specifying how to extract coordinates")
+        if not tiles or len(tiles) == 0:
+            raise Exception("Cannot create a mosaic without a tiles list")
+        if threshold < 0:
+            raise Exception(f"Illegal threshold: {threshold}. Please use a non-negative value.")
+        library = tiles if isinstance(tiles, TileLibrary) else TileLibrary.from_tiles(list(tiles))
+        self.__library = library.copy()
+        self.__coordinator = coordinator
+        self.__grid = grid
+        self.__reinsertion = reinsertion
+        self.__threshold = threshold
+        self.__metric = get_metric(metric)
+        check_color_space(self.__metric, coordinator)
+        self.__render_cache = render_cache if render_cache is not None else TileRenderCache()
+        n_cells = grid[0] * grid[1]
+        if not reinsertion and self.__library.total_quantity() < n_cells:
+            raise Exception(f"Not enough tiles: {self.__library.total_quantity()} available for {n_cells} cells")
+        # Coordinates of the cells when they were assigned, and their tiles
+        self.__coords = None
+        self.__assigned = np.full(shape=n_cells, fill_value=NO_TILE, dtype=np.intp)
+        self.__scale = None
+        self.__output = None
+        self.__frames = 0
+
+    @property
+    def frames(self) -> int:
+        return self.__frames
+
+    @property
+    def assigned(self) -> np.ndarray:
+        """
+        The index of the tile assigned to every cell, in row-major order.
+        """
+        return self.__assigned
+
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Composes the mosaic of the next frame.
+        :param frame: The frame, as a RGB image with the same size of the previous ones
+        :return: The image of the mosaic. The same buffer is updated at every frame: it must be copied to be kept.
+        """
+        if self.__scale is None:
+            self.__scale = (frame.shape[0] // self.__grid[0], frame.shape[1] // self.__grid[1])
+            self.__output = np.zeros(shape=(frame.shape[0], frame.shape[1], 3), dtype=np.uint8)
+        elif frame.shape[:2] != self.__output.shape[:2]:
+            raise Exception(f"The frame with shape {frame.shape} doesn't match the previous ones")
+
+        with INSTRUMENTATION.stage("target_featurization"):
+            coords = self.__coordinator.compute_grid(frame, self.__grid).astype(DISTANCE_DTYPE)
+        if self.__coords is None:
+            changed = np.arange(len(coords))
+            self.__coords = coords
+        else:
+            moved = self.__metric.paired(coords, self.__coords)
+            changed = np.flatnonzero(moved > self.__threshold)
+        INSTRUMENTATION.count("cells_refreshed", len(changed))
+
+        if len(changed) > 0:
+            with INSTRUMENTATION.stage("assign_tiles"):
+                self.__reassign(changed, coords[changed])
+            self.__coords[changed] = coords[changed]
+            with INSTRUMENTATION.stage("render"):
+                self.__render(changed)
+        self.__frames += 1
+        return self.__output
+
+    def __reassign(self, changed: np.ndarray, coords: np.ndarray) -> None:
+        """
+        Assigns again the changed cells, after they've given back their tiles.
+        """
+        library = self.__library
+        if self.__reinsertion:
+            (nearest, _) = nearest_tiles(coords, library.coords, metric=self.__metric)
+            self.__assigned[changed] = nearest
+            return
+
+        previous = self.__assigned[changed]
+        np.add.at(library.quantities, previous[previous != NO_TILE], 1)
+        self.__assigned[changed] = assign_greedily(coords, library, metric=self.__metric)
+
+    def __render(self, changed: np.ndarray) -> None:
+        """
+        Redraws the changed cells only, grouping them by tile.
+        """
+        view = grid_view(self.__output, self.__grid, self.__scale)
+        tiles = self.__assigned[changed]
+        for tile_index in np.unique(tiles):
+            (rows, cols) = np.divmod(changed[tiles == tile_index], self.__grid[1])
+            view[rows, :, cols, :] = self.__render_cache.get(self.__library[int(tile_index)], self.__scale)
+
+
+def read_frames(source: str):
+    """
+    Reads the frames of a sequence one at a time.
+    :param source: A video file, or a folder of images (read in alphabetical order)
+    :return: A generator of RGB frames
+    """
+    if os.path.isdir(source):
+        for path in list_targets([source]):
+            yield load_image(path)
+        return
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise Exception(f"Impossible to open the video <{source}>")
+    try:
+        while True:
+            (ok, frame) = capture.read()
+            if not ok:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+class FrameWriter:
+    """
+    Writer of a sequence of frames: either a video file, or numbered images in a folder.
+    A destination with the extension of an image format (or without extension) is a folder of images.
+    """
+
+    def __init__(self, destination: str, fps: float = DEFAULT_FPS, fourcc: str = DEFAULT_FOURCC):
+        """
+        Constructor.
+        :param destination: The path of the video file, or of the folder of images
+        :param fps: The frame rate of the video
+        :param fourcc: The code of the video codec
+        """
+        self.__destination = destination
+        self.__fps = fps
+        self.__fourcc = fourcc
+        (_, extension) = os.path.splitext(destination)
+        self.__as_images = extension == "" or extension.lower() in TARGET_EXTENSIONS
+        self.__video = None
+        self.__count = 0
+        if self.__as_images:
+            os.makedirs(destination, exist_ok=True)
+
+    def write(self, frame: np.ndarray) -> None:
+        """
+        Writes the next frame.
+        :param frame: The RGB frame
+        """
+        bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if self.__as_images:
+            path = os.path.join(self.__destination, FRAME_NAME_FORMAT.format(self.__count))
+            if not cv2.imwrite(path, bgr):
+                raise Exception(f"Impossible to write the image <{path}>")
+        else:
+            if self.__video is None:
+                self.__video = cv2.VideoWriter(self.__destination, cv2.VideoWriter_fourcc(*self.__fourcc), self.__fps,
+                                               (frame.shape[1], frame.shape[0]))
+                if not self.__video.isOpened():
+                    raise Exception(f"Impossible to write the video <{self.__destination}>")
+            self.__video.write(bgr)
+        self.__count += 1
+
+    def close(self) -> None:
+        if self.__video is not None:
+            self.__video.release()
+            self.__video = None
+
+    def __enter__(self) -> "FrameWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Composes the mosaics of the frames of a video or of an image sequence")
+    add_library_arguments(parser)
+    parser.add_argument("--input", required=True, help="video file, or folder of images")
+    parser.add_argument("--output", required=True, help="video file, or folder where the numbered images are written")
+    parser.add_argument("--reinsertion", action="store_true", help="use the tiles without limits")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="distance the coordinates of a cell must move before it's assigned again")
+    parser.add_argument("--fps", type=float, default=DEFAULT_FPS, help="frame rate of the output video")
+    args = parser.parse_args()
+
+    (coor, library) = load_library(args)
+    sequence = MosaicSequence(coor, library, grid=args.grid, reinsertion=args.reinsertion, threshold=args.threshold)
+    with FrameWriter(args.output, fps=args.fps) as writer:
+        for image in read_frames(args.input):
+            writer.write(sequence.process(image))
+    print(f"{sequence.frames} frames written to <{args.output}>")
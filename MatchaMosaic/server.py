@@ -0,0 +1,206 @@
+"""
+Resident worker: the coordinator and the tiles library are loaded once, then mosaics are composed on request.
+Jobs are JSON objects, one per line, read from the standard input or from the connections to a Unix socket:
+
+    {"id": 1, "target": "image/shrek3.jpg", "output": "out/shrek3.png", "grid": [42, 57], "reinsertion": true}
+
+Only "target" and "output" are mandatory; "grid" (a list or a string like "42x57"), "reinsertion" and "solver" fall
+back to the defaults of the worker. Every job is answered with one JSON line, carrying back its "id", as soon as it's
+completed: the answers can arrive in a different order than the jobs.
+The front end runs on asyncio and dispatches the jobs to a pool of processes, which attach to the coordinates of the
+tiles in shared memory instead of receiving their own copy of them. Every process keeps the resized tiles of its jobs
+in a cache bounded by a budget of bytes. Each job works on a fresh copy of the quantities, so concurrent jobs never
+consume each other's tiles.
+The standard output is reserved to the answers: everything else printed by the pipeline goes to the standard error.
+
+Usage:
+    python server.py --tiles tiles/tiles_info.csv < jobs.jsonl
+    python server.py --tiles tiles/tiles_info.csv --socket /tmp/matcha.sock --workers 4
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from arguments import add_library_arguments, load_library
+from batch import compose_target, init_worker, share_library
+from coordinates import Coordinator
+from mosaic import DEFAULT_GRID_SHAPE, DEFAULT_REINSERTION, DEFAULT_SOLVER, SOLVER_GREEDY, SOLVER_OPTIMAL
+from tiles import TileLibrary
+from utilities import parse_grid
+
+DEFAULT_SERVER_WORKERS = 1
+
+
+def _init_server_worker(coordinator: Coordinator, library: dict, options: dict) -> None:
+    # The standard output of the server carries the answers only
+    sys.stdout = sys.stderr
+    # Interrupting the server stops the front end, which then waits for the running jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(coordinator, library, options)
+
+
+class MosaicServer:
+    """
+    Resident worker keeping the tiles library loaded between the jobs.
+    """
+
+    def __init__(self, coordinator: Coordinator, library: TileLibrary, workers: int = DEFAULT_SERVER_WORKERS,
+                 grid: (int, int) = DEFAULT_GRID_SHAPE, reinsertion: bool = DEFAULT_REINSERTION,
+                 solver: str = DEFAULT_SOLVER):
+        """
+        Constructor.
+        The processes of the pool are spawned, not forked: a forked process would inherit the connections open at
+        that moment, keeping them alive after the server closes them.
+        :param coordinator: The coordinator used to compute the coordinates of the cells
+        :param library: The tiles library, already ingested
+        :param workers: The number of processes composing the mosaics
+        :param grid: The grid used by the jobs which don't specify one
+        :param reinsertion: The reinsertion used by the jobs which don't specify it
+        :param solver: The assignment strategy used by the jobs which don't specify one
+        """
+        if workers is None or workers < 1:
+            raise Exception(f"Illegal number of workers: {workers}. Please use a positive value.")
+        self.__defaults = {"grid": grid, "reinsertion": reinsertion, "solver": solver}
+        (self.__segment, shared) = share_library(library)
+        self.__executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=_init_server_worker,
+                                              initargs=(coordinator, shared, self.__defaults))
+
+    def close(self) -> None:
+        self.__executor.shutdown(wait=True)
+        # The workers are gone: the coordinates of the tiles can be released
+        self.__segment.close()
+        self.__segment.unlink()
+
+    def __enter__(self) -> "MosaicServer":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def parse_job(self, job: dict) -> (str, str, dict):
+        """
+        Reads a job, filling the missing options with the defaults.
+        :param job: The job, as decoded from its JSON line
+        :return: The target, the output path and the options of the mosaic
+        """
+        for key in ("target", "output"):
+            if not job.get(key):
+                raise Exception(f"Missing \"{key}\" in the job")
+        grid = job.get("grid", self.__defaults["grid"])
+        grid = parse_grid(grid) if isinstance(grid, str) else (int(grid[0]), int(grid[1]))
+        solver = job.get("solver", self.__defaults["solver"])
+        if solver not in (SOLVER_GREEDY, SOLVER_OPTIMAL):
+            raise Exception(f"Unknown solver: {solver}")
+        options = {"grid": grid, "reinsertion": bool(job.get("reinsertion", self.__defaults["reinsertion"])),
+                   "solver": solver}
+        return job["target"], job["output"], options
+
+    async def handle(self, line: str) -> dict:
+        """
+        Runs a job in the pool, without blocking the event loop.
+        :param line: The JSON line describing the job
+        :return: The answer to the job
+        """
+        job_id = None
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise Exception("a job must be a JSON object")
+            job_id = job.get("id")
+            (target, output, options) = self.parse_job(job)
+        except Exception as e:
+            return {"id": job_id, "status": "error", "error": f"Invalid job: {e}"}
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.__executor, compose_target, target, output, options)
+        if result["output"] is None:
+            return {"id": job_id, "status": "error", "target": target, "error": result["error"]}
+        return {"id": job_id, "status": "ok", "target": target, "output": output, "seconds": result["seconds"]}
+
+    async def serve_lines(self, reader: asyncio.StreamReader, write) -> None:
+        """
+        Reads the jobs from a stream until its end, answering every one of them as soon as it's completed.
+        :param reader: The stream of JSON lines
+        :param write: The function writing an answer line
+        """
+        pending = set()
+
+        async def answer(line: str) -> None:
+            write(json.dumps(await self.handle(line)) + "\n")
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode().strip()
+            if line:
+                task = asyncio.create_task(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def serve_stdio(self) -> None:
+        """
+        Serves the jobs read from the standard input, answering on the standard output.
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        def write(text: str) -> None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        await self.serve_lines(reader, write)
+
+    async def serve_unix(self, path: str) -> None:
+        """
+        Serves the jobs sent to a Unix socket, answering on the same connection. Runs until it's cancelled.
+        :param path: The path of the socket; a stale file at the same path is replaced
+        """
+        async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                await self.serve_lines(reader, lambda text: writer.write(text.encode()))
+                await writer.drain()
+            finally:
+                writer.close()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(on_connection, path=path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Resident worker composing mosaics with a tiles library kept loaded")
+    add_library_arguments(parser, grid_help="default grid, e.g. 42x57")
+    parser.add_argument("--reinsertion", action="store_true", help="use the tiles without limits by default")
+    parser.add_argument("--solver", choices=[SOLVER_GREEDY, SOLVER_OPTIMAL], default=DEFAULT_SOLVER)
+    parser.add_argument("--workers", type=int, default=DEFAULT_SERVER_WORKERS, help="number of worker processes")
+    parser.add_argument("--socket", help="path of the Unix socket; the standard input is used if not given")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        (coor, tiles) = load_library(args)
+    with MosaicServer(coor, tiles, workers=args.workers, grid=args.grid, reinsertion=args.reinsertion,
+                      solver=args.solver) as mosaic_server:
+        try:
+            if args.socket:
+                print(f"Listening on <{args.socket}>", file=sys.stderr)
+                asyncio.run(mosaic_server.serve_unix(args.socket))
+            else:
+                asyncio.run(mosaic_server.serve_stdio())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,220 @@
+import heapq
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from distances import compute_distance_matrix
+from instrumentation import INSTRUMENTATION
+
+DEFAULT_LEAF_SIZE = 32
+DEFAULT_BATCH_SIZE = 1024
+
+
+class TileIndex(ABC):
+    """
+    Abstract nearest-neighbour index over the coordinates of the tiles.
+    Tiles can be removed from the index (e.g. when they run out), so that queries only return the active ones.
+    """
+
+    def __init__(self, points: np.ndarray):
+        """
+        Constructor.
+        :param points: The (T, d) matrix of the tiles coordinates; the index of a row identifies the tile
+        """
+        if points.ndim != 2 or points.shape[0] == 0:
+            raise Exception("Cannot build an index without points")
+        self._points = np.asarray(points, dtype=np.float64)
+        self._active = np.ones(shape=points.shape[0], dtype=bool)
+        self._n_active = points.shape[0]
+
+    def __len__(self) -> int:
+        """
+        The number of active points.
+        """
+        return self._n_active
+
+    def is_active(self, i: int) -> bool:
+        return bool(self._active[i])
+
+    def remove(self, i: int) -> None:
+        """
+        Removes a point from the index. Removing a point twice has no effect.
+        :param i: The index of the point
+        """
+        if self._active[i]:
+            self._active[i] = False
+            self._n_active -= 1
+
+    @abstractmethod
+    def query(self, point: np.ndarray) -> (int, float):
+        """
+        Finds the active point nearest to the given one.
+        :param point: The coordinates to look for
+        :return: The index of the nearest point and its distance
+        """
+        pass
+
+    def query_batch(self, points: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Finds the active point nearest to each of the given ones.
+        The default implementation simply calls "query" for every point.
+        :param points: The (N, d) matrix of coordinates to look for
+        :return: The array of the indices of the nearest points and the array of their distances
+        """
+        results = [self.query(p) for p in points]
+        indices = np.array([r[0] for r in results], dtype=np.intp)
+        distances = np.array([r[1] for r in results])
+        return indices, distances
+
+
+class BruteForceIndex(TileIndex):
+    """
+    Index comparing the query with every active point.
+    It has no building cost and it's the fastest choice for small libraries.
+    """
+
+    def query(self, point: np.ndarray) -> (int, float):
+        if self._n_active == 0:
+            raise Exception("Available list is empty: cannot find an usable tile")
+        INSTRUMENTATION.count("distances_evaluated", self._points.shape[0])
+        distances = np.linalg.norm(self._points - point, axis=1)
+        distances[~self._active] = np.inf
+        i = int(np.argmin(distances))
+        return i, float(distances[i])
+
+    def query_batch(self, points: np.ndarray, batch_size: int = DEFAULT_BATCH_SIZE) -> (np.ndarray, np.ndarray):
+        if self._n_active == 0:
+            raise Exception("Available list is empty: cannot find an usable tile")
+        indices = np.empty(shape=points.shape[0], dtype=np.intp)
+        distances = np.empty(shape=points.shape[0])
+        # Working in batches bounds the size of the distances matrix
+        for start in range(0, points.shape[0], batch_size):
+            block = compute_distance_matrix(points[start:start + batch_size], self._points)
+            block[:, ~self._active] = np.inf
+            block_indices = np.argmin(block, axis=1)
+            indices[start:start + batch_size] = block_indices
+            distances[start:start + batch_size] = block[np.arange(block.shape[0]), block_indices]
+        return indices, distances
+
+
+class KDTreeIndex(TileIndex):
+    """
+    KD-tree index, for large libraries of tiles.
+    The space is split recursively along the dimension with the largest spread, until every leaf contains only a
+    few points. Removed points are masked, and every node keeps the count of its active points so that empty
+    subtrees are skipped.
+    The search can be approximate: with a positive "epsilon" the returned point is at most (1 + epsilon) times farther
+    than the real nearest one, and many more branches are pruned.
+    """
+
+    def __init__(self, points: np.ndarray, leaf_size: int = DEFAULT_LEAF_SIZE, epsilon: float = 0.0):
+        """
+        Builds the tree.
+        :param points: The (T, d) matrix of the tiles coordinates
+        :param leaf_size: The maximum number of points in a leaf
+        :param epsilon: The tolerance of the approximate search; zero means exact search
+        """
+        super().__init__(points)
+        if leaf_size < 1:
+            raise Exception(f"Illegal leaf size: {leaf_size}. Please use a positive value.")
+        if epsilon < 0:
+            raise Exception(f"Illegal tolerance: {epsilon}. Please use a non-negative value.")
+        self.__leaf_size = leaf_size
+        self.__prune_factor = (1 + epsilon) ** 2
+
+        # Points are permuted so that every node covers a contiguous range
+        self.__order = np.arange(points.shape[0])
+        # Nodes are stored as parallel lists; leaves have no children (-1)
+        self.__start = []
+        self.__end = []
+        self.__left = []
+        self.__right = []
+        self.__parent = []
+        self.__build()
+
+        # Bounding box of the points of every node, used to bound the distance from a query
+        self.__lower = np.empty(shape=(len(self.__start), points.shape[1]))
+        self.__upper = np.empty(shape=(len(self.__start), points.shape[1]))
+        for node in range(len(self.__start)):
+            subset = self._points[self.__order[self.__start[node]:self.__end[node]]]
+            self.__lower[node] = subset.min(axis=0)
+            self.__upper[node] = subset.max(axis=0)
+
+        self.__count = np.array([end - start for (start, end) in zip(self.__start, self.__end)])
+        self.__leaf_of = np.empty(shape=points.shape[0], dtype=np.intp)
+        for node in range(len(self.__start)):
+            if self.__left[node] < 0:
+                self.__leaf_of[self.__order[self.__start[node]:self.__end[node]]] = node
+        # The points of every leaf, in tree order, for the brute-force search inside the leaves
+        self.__sorted_points = self._points[self.__order]
+
+    def __new_node(self, start: int, end: int, parent: int) -> int:
+        self.__start.append(start)
+        self.__end.append(end)
+        self.__left.append(-1)
+        self.__right.append(-1)
+        self.__parent.append(parent)
+        return len(self.__start) - 1
+
+    def __build(self) -> None:
+        stack = [self.__new_node(0, len(self.__order), -1)]
+        while stack:
+            node = stack.pop()
+            (start, end) = (self.__start[node], self.__end[node])
+            if end - start <= self.__leaf_size:
+                continue
+            subset = self._points[self.__order[start:end]]
+            spread = subset.max(axis=0) - subset.min(axis=0)
+            dim = int(np.argmax(spread))
+            if spread[dim] == 0:
+                # All the points are identical: the node stays a leaf
+                continue
+            # Splitting on the median
+            mid = (end - start) // 2
+            partition = np.argpartition(subset[:, dim], mid)
+            self.__order[start:end] = self.__order[start:end][partition]
+            self.__left[node] = self.__new_node(start, start + mid, node)
+            self.__right[node] = self.__new_node(start + mid, end, node)
+            stack.append(self.__left[node])
+            stack.append(self.__right[node])
+
+    def remove(self, i: int) -> None:
+        if not self._active[i]:
+            return
+        super().remove(i)
+        # Updating the counts up to the root
+        node = self.__leaf_of[i]
+        while node >= 0:
+            self.__count[node] -= 1
+            node = self.__parent[node]
+
+    def query(self, point: np.ndarray) -> (int, float):
+        if self._n_active == 0:
+            raise Exception("Available list is empty: cannot find an usable tile")
+        point = np.asarray(point, dtype=np.float64)
+        best_index = -1
+        best_sq_dist = np.inf
+        # Nodes are visited from the nearest one, according to the distance from their bounding box
+        heap = [(0.0, 0)]
+        while heap:
+            (bound, node) = heapq.heappop(heap)
+            if bound * self.__prune_factor >= best_sq_dist:
+                # No other node can contain a nearer point
+                break
+            if self.__left[node] < 0:
+                # Leaf: checking all its active points
+                (start, end) = (self.__start[node], self.__end[node])
+                INSTRUMENTATION.count("distances_evaluated", end - start)
+                diff = self.__sorted_points[start:end] - point
+                sq_dist = np.einsum("ij,ij->i", diff, diff)
+                sq_dist[~self._active[self.__order[start:end]]] = np.inf
+                k = int(np.argmin(sq_dist))
+                if sq_dist[k] < best_sq_dist:
+                    best_sq_dist = float(sq_dist[k])
+                    best_index = int(self.__order[start + k])
+                continue
+            children = [c for c in (self.__left[node], self.__right[node]) if self.__count[c] > 0]
+            gaps = np.maximum(self.__lower[children] - point, 0) + np.maximum(point - self.__upper[children], 0)
+            for (child, child_bound) in zip(children, np.einsum("ij,ij->i", gaps, gaps)):
+                heapq.heappush(heap, (float(child_bound), child))
+        return best_index, float(np.sqrt(best_sq_dist))
@@ -0,0 +1,178 @@
+"""
+Striped mode: mosaics of targets and outputs too large to be kept in memory.
+The target is processed in horizontal bands of cell rows. A first pass computes the coordinates of the cells band by
+band; only the coordinates of all the cells are kept, and they're much smaller than the pixels. Then the tiles are
+assigned, and a second pass draws the mosaic band by band into an output file mapped in memory. The pixels in memory
+at any time are the ones of a band of the target, or of a band of the output.
+The target is read band by band when it's a raw image (".npy", see imagestore.save_raw_image), which is mapped in
+memory; the other formats can't be decoded partially, so they're loaded whole once.
+
+Usage:
+    python striped.py --tiles tiles/tiles_info.csv --target big.npy --output mosaic.npy --grid 400x600
+    python striped.py --tiles tiles/tiles_info.csv --target big.npy --output mosaic.npy --grid 400x600 --cell 64x64
+"""
+import argparse
+
+import numpy as np
+
+from arguments import add_library_arguments, load_library
+from assignment import assign_greedily
+from coordinates import Coordinator
+from distances import DISTANCE_DTYPE, nearest_tiles
+from imagestore import RAW_IMAGE_EXTENSION, load_raw_image
+from instrumentation import INSTRUMENTATION
+from metrics import DEFAULT_METRIC, check_color_space, get_metric
+from mosaic import DEFAULT_GRID_SHAPE, DEFAULT_REINSERTION
+from rendering import TileRenderCache, grid_view
+from tiles import Tile, TileLibrary
+from utilities import load_image, parse_grid
+
+DEFAULT_BAND_ROWS = 8
+
+
+def open_target(targetpath: str) -> np.ndarray:
+    """
+    Opens a target image. Raw images are mapped in memory, so that their pixels are read only when they're accessed.
+    :param targetpath: The path of the image
+    :return: The RGB image
+    """
+    if targetpath.endswith(RAW_IMAGE_EXTENSION):
+        img = load_raw_image(targetpath)
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise Exception(f"The raw image <{targetpath}> is not a RGB image: its shape is {img.shape}")
+        return img
+    return load_image(targetpath)
+
+
+class StripedMosaic:
+    """
+    Mosaic composed band by band, writing the output to a file mapped in memory.
+    The cells and the tiles are handled as matrices: there's no Cell object, and no image of the whole target or of the
+    whole output. If the size of the target is not a multiple of the grid, the remaining pixels on the bottom and on
+    the right are ignored, as in the Mosaic; the output covers exactly the cells.
+    """
+
+    def __init__(self, targetpath: str, coordinator: Coordinator, tiles: [Tile], grid: (int, int) = DEFAULT_GRID_SHAPE,
+                 reinsertion: bool = DEFAULT_REINSERTION, band_rows: int = DEFAULT_BAND_ROWS,
+                 render_cache: TileRenderCache = None, metric=DEFAULT_METRIC):
+        """
+        Creates the mosaic, computing the coordinates of the cells one band at a time.
+        :param targetpath: The path of the target image; a ".npy" raw image is read band by band
+        :param coordinator: The coordinator used to compute the coordinates of the cells
+        :param tiles: The available tiles; their quantities are consumed as in the Mosaic
+        :param grid: The number of rows and columns of cells
+        :param reinsertion: Whether the tiles can be used without limits
+        :param band_rows: The number of rows of cells processed together
+        :param render_cache: An optional cache of the resized tiles
+        :param metric: The distance between the coordinates (see Mosaic)
+        """
+        if not targetpath:
+            raise Exception("Cannot create a mosaic without the target image")
+        if not coordinator:
+            raise Exception("Cannot create a mosaic without specifying how to extract coordinates")
+        if not tiles or len(tiles) == 0:
+            raise Exception("Cannot create a mosaic without a tiles list")
+        if band_rows < 1:
+            raise Exception(f"Illegal number of rows per band: {band_rows}. Please use a positive value.")
+        self.__library = tiles if isinstance(tiles, TileLibrary) else TileLibrary.from_tiles(list(tiles))
+        self.__grid = grid
+        self.__reinsertion = reinsertion
+        self.__band_rows = band_rows
+        self.__metric = get_metric(metric)
+        check_color_space(self.__metric, coordinator)
+        self.__render_cache = render_cache if render_cache is not None else TileRenderCache()
+        self.__assigned = None
+
+        with INSTRUMENTATION.stage("target_loading"):
+            target = open_target(targetpath)
+        self.__scale = (target.shape[0] // grid[0], target.shape[1] // grid[1])
+        if self.__scale[0] == 0 or self.__scale[1] == 0:
+            raise Exception(f"The grid {grid} is too thick for an image with shape {target.shape}")
+        with INSTRUMENTATION.stage("target_featurization"):
+            self.__coords = np.concatenate([
+                coordinator.compute_grid(np.asarray(band), (rows, grid[1])).astype(DISTANCE_DTYPE)
+                for (rows, band) in self.__bands(target, self.__scale)
+            ])
+
+    def __bands(self, image: np.ndarray, cell_shape: (int, int)):
+        """
+        Splits an image into bands of cell rows, covering exactly the columns of cells.
+        :return: A generator of the number of cell rows and the pixels of every band
+        """
+        (cell_h, cell_w) = cell_shape
+        for first in range(0, self.__grid[0], self.__band_rows):
+            rows = min(self.__band_rows, self.__grid[0] - first)
+            yield rows, image[first * cell_h:(first + rows) * cell_h, :self.__grid[1] * cell_w]
+
+    @property
+    def coords(self) -> np.ndarray:
+        """
+        The coordinates of the cells, one row per cell in row-major order.
+        """
+        return self.__coords
+
+    @property
+    def assigned(self) -> np.ndarray:
+        """
+        The index of the tile assigned to every cell, in row-major order; None before the assignment.
+        """
+        return self.__assigned
+
+    def assign_tiles(self) -> None:
+        """
+        Assigns a tile to every cell, with the same strategy of the Mosaic.
+        """
+        with INSTRUMENTATION.stage("assign_tiles"):
+            if self.__reinsertion:
+                (self.__assigned, _) = nearest_tiles(self.__coords, self.__library.coords, metric=self.__metric)
+            else:
+                self.__assigned = assign_greedily(self.__coords, self.__library, metric=self.__metric)
+
+    def render(self, outputpath: str, cell_shape: (int, int) = None) -> np.ndarray:
+        """
+        Draws the mosaic into a raw image file, one band at a time.
+        The file is created with the size of the cells, and it's mapped in memory: the pages of a band are written to
+        the disk before the next band is drawn.
+        :param outputpath: The path of the ".npy" output file
+        :param cell_shape: The height and width of every cell in the output; the ones of the target if not given, but
+        a larger size is allowed (e.g. for printing)
+        :return: The output image, mapped in memory
+        """
+        if self.__assigned is None:
+            raise Exception("Cannot render the mosaic: the tiles have not been assigned")
+        if not outputpath.endswith(RAW_IMAGE_EXTENSION):
+            raise Exception(f"The output of a striped mosaic must be a raw image, with the \"{RAW_IMAGE_EXTENSION}\" "
+                            f"extension")
+        cell_shape = tuple(cell_shape) if cell_shape is not None else self.__scale
+        shape = (self.__grid[0] * cell_shape[0], self.__grid[1] * cell_shape[1], 3)
+        with INSTRUMENTATION.stage("render"):
+            output = np.lib.format.open_memmap(outputpath, mode="w+", dtype=np.uint8, shape=shape)
+            assigned = self.__assigned.reshape(self.__grid)
+            first = 0
+            for (rows, band) in self.__bands(output, cell_shape):
+                view = grid_view(band, (rows, self.__grid[1]), cell_shape)
+                band_tiles = assigned[first:first + rows]
+                for tile_index in np.unique(band_tiles):
+                    (band_rows, cols) = np.nonzero(band_tiles == tile_index)
+                    view[band_rows, :, cols, :] = self.__render_cache.get(self.__library[int(tile_index)], cell_shape)
+                output.flush()
+                first += rows
+        return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Composes a mosaic too large for the memory, one band at a time")
+    add_library_arguments(parser, grid_help="rows and columns, e.g. 400x600")
+    parser.add_argument("--target", required=True, help="target image; a \".npy\" raw image is read band by band")
+    parser.add_argument("--output", required=True, help="path of the \".npy\" raw output image")
+    parser.add_argument("--reinsertion", action="store_true", help="use the tiles without limits")
+    parser.add_argument("--band-rows", type=int, default=DEFAULT_BAND_ROWS, help="rows of cells in every band")
+    parser.add_argument("--cell", type=parse_grid, help="size of the cells in the output, e.g. 64x64")
+    args = parser.parse_args()
+
+    (coor, library) = load_library(args)
+    mosaic = StripedMosaic(args.target, coor, library, grid=args.grid, reinsertion=args.reinsertion,
+                           band_rows=args.band_rows)
+    mosaic.assign_tiles()
+    image = mosaic.render(args.output, cell_shape=args.cell)
+    print(f"Mosaic with shape {image.shape} written to <{args.output}>")
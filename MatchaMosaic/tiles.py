@@ -1,8 +1,14 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
 
+from cache import CACHE_FILE_SUFFIX, FeatureCache
 from coordinates import Coordinator
+from distances import DISTANCE_DTYPE
+from instrumentation import INSTRUMENTATION
+from imagestore import DEFAULT_BUDGET_BYTES, RAW_IMAGE_EXTENSION, ImageStore, load_raw_image
 from utilities import show_image, load_image
 import csv
 
@@ -16,53 +22,100 @@ CSV_COL_NAME = "name"
 CSV_COL_FILENAME = "filename"
 CSV_COL_QUANTITY = "quantity"
 
+DEFAULT_USE_CACHE = True
+DEFAULT_WORKERS = 1
+FOLDER_CACHE_NAME = "tiles"
+
 
 class Tile:
     """
     Tile class. A tile represents one usable asset in the final mosaic image.
+    The data of a tile are stored in a TileLibrary: the tile object is only a lightweight view over one of its entries.
     """
 
-    def __init__(self, name: str, img: np.ndarray, coordinator: Coordinator, quantity: int = 1):
+    __slots__ = ("__library", "__index")
+
+    def __init__(self, name: str, img: np.ndarray, coordinator: Coordinator, quantity: int = 1,
+                 filepath: str = None, coords: np.ndarray = None):
         """
         Constructor.
+        The tile is stored in a new library of its own; it's moved to a shared one when the library is built from a
+        list of tiles (see TileLibrary.from_tiles).
+        The image can be omitted if the path of its file is given: in that case it's loaded the first time it's needed.
         :param name: The name used to univocally identify the tile
         :param img: The image the tile represent, as a numpy array with 3 channels
         :param quantity: The available quantity of the tile
+        :param filepath: The path of the image file, used to load the image lazily
+        :param coords: The coordinates of the tile, if they're already known (e.g. from a cache)
         """
-        self.name = name
-        if img is None:
+        if img is None and not filepath:
             raise Exception(f'No image found in creating tile "{name}"')
+        image = self.preprocess_tile_image(img) if img is not None else filepath
+        if coords is None:
+            # The image loaded from the file is not kept: the library will load it again when needed
+            coords = coordinator.compute(image if img is not None else load_tile_image(filepath))
 
-        cropped_img = self.preprocess_tile_image(img)
-        self.__tile_image = cropped_img
-        self.coords = coordinator.compute(cropped_img)
+        library = TileLibrary([name], np.array([coords]), [quantity], [image])
+        self.__library = library
+        self.__index = 0
+        library.bind(self, 0)
 
-        if quantity < 1:
-            raise Exception("No tile can have zero quantity available. Please set a positive number")
-        self.__qty = quantity
+    def bind(self, library: "TileLibrary", index: int) -> None:
+        """
+        Moves the view over an entry of another library.
+        :param library: The library containing the data of the tile
+        :param index: The position of the tile in the library
+        """
+        self.__library = library
+        self.__index = index
+
+    @classmethod
+    def view(cls, library: "TileLibrary", index: int) -> "Tile":
+        """
+        Creates a view over an entry of a library, without computing anything.
+        :param library: The library containing the data of the tile
+        :param index: The position of the tile in the library
+        :return: The tile
+        """
+        tile = cls.__new__(cls)
+        tile.bind(library, index)
+        return tile
+
+    @property
+    def library(self) -> "TileLibrary":
+        return self.__library
+
+    @property
+    def index(self) -> int:
+        return self.__index
+
+    @property
+    def name(self) -> str:
+        return self.__library.names[self.__index]
+
+    @property
+    def coords(self) -> np.ndarray:
+        return self.__library.coords[self.__index]
 
     @property
     def image(self):
-        return self.__tile_image
+        return self.__library.get_image(self.__index)
 
     def is_available(self) -> bool:
-        return self.__qty > 0
+        return self.__library.quantities[self.__index] > 0
 
     def use(self, quantity: int = 1) -> None:
-        if self.__qty < quantity:
-            raise Exception(f"Impossible to use the requested quantity ({quantity}) of this tile: "
-                            f"only {self.__qty} available")
-        self.__qty -= quantity
+        self.__library.use(self.__index, quantity)
 
     def print_coords(self) -> None:
         print(self.coords)
 
     @property
     def quantity(self):
-        return self.__qty
+        return int(self.__library.quantities[self.__index])
 
     def show_preview(self):
-        show_image(self.__tile_image)
+        show_image(self.image)
 
     @classmethod
     def preprocess_tile_image(cls, img):
@@ -88,37 +141,273 @@ class Tile:
         return img_cut
 
 
+class TileLibrary:
+    """
+    Compact collection of tiles.
+    The data of all the tiles are kept in parallel structures: a list of names, a contiguous matrix of coordinates
+    (one row per tile), an array of quantities and a list of image handles. This allows checking the availability and
+    updating the quantities of many tiles at once.
+    The library behaves like a list of Tile objects: every tile is a view over one of its entries.
+    """
+
+    def __init__(self, names: [str], coords: np.ndarray, quantities: [int], images: list, store: ImageStore = None):
+        """
+        Constructor.
+        :param names: The names of the tiles
+        :param coords: The (T, d) matrix of the tiles coordinates
+        :param quantities: The available quantity of every tile
+        :param images: The handle of every image: either the preprocessed image, or the path of its file (which is
+        loaded when it's needed)
+        :param store: The store loading and caching the images from their files; a new one is used if not given
+        """
+        if not (len(names) == len(coords) == len(quantities) == len(images)):
+            raise Exception("Inconsistent tiles data: names, coordinates, quantities and images must have the same "
+                            "length")
+        self.names = list(names)
+        self.coords = np.ascontiguousarray(coords, dtype=DISTANCE_DTYPE)
+        self.quantities = np.array(quantities, dtype=np.int64)
+        if np.any(self.quantities < 1):
+            raise Exception("No tile can have zero quantity available. Please set a positive number")
+        self.__images = list(images)
+        self.__store = store if store is not None else ImageStore(load_tile_image)
+        self.__tiles = [Tile.view(self, i) for i in range(len(self.names))]
+
+    @classmethod
+    def from_tiles(cls, tiles: [Tile]) -> "TileLibrary":
+        """
+        Gathers a list of tiles into a single library.
+        The tiles are moved over the new library, so they keep working as before (with their current quantities).
+        :param tiles: The tiles
+        :return: The library
+        """
+        library = cls(
+            names=[t.name for t in tiles],
+            coords=np.array([t.coords for t in tiles]),
+            quantities=[t.quantity for t in tiles],
+            images=[t.library.get_image_handle(t.index) for t in tiles]
+        )
+        for (i, tile) in enumerate(tiles):
+            library.bind(tile, i)
+        return library
+
+    def bind(self, tile: Tile, index: int) -> None:
+        """
+        Makes a tile the view of an entry of the library.
+        """
+        tile.bind(self, index)
+        self.__tiles[index] = tile
+
+    def copy(self) -> "TileLibrary":
+        """
+        Creates a library with the same tiles and an independent copy of the quantities.
+        The coordinates and the images are shared.
+        :return: The new library
+        """
+        library = TileLibrary.__new__(TileLibrary)
+        library.names = self.names
+        library.coords = self.coords
+        library.quantities = self.quantities.copy()
+        library.__images = self.__images
+        library.__store = self.__store
+        library.__tiles = [Tile.view(library, i) for i in range(len(self.names))]
+        return library
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> Tile:
+        return self.__tiles[index]
+
+    def __iter__(self):
+        return iter(self.__tiles)
+
+    @property
+    def store(self) -> ImageStore:
+        return self.__store
+
+    def get_image_handle(self, index: int):
+        return self.__images[index]
+
+    def get_image(self, index: int) -> np.ndarray:
+        """
+        Returns the preprocessed image of a tile, going through the image store.
+        :param index: The position of the tile
+        :return: The image
+        """
+        return self.__store.get(self.__images[index])
+
+    def available(self) -> np.ndarray:
+        """
+        Checks the availability of all the tiles at once.
+        :return: A boolean array, True for the tiles with positive quantity
+        """
+        return self.quantities > 0
+
+    def use(self, index: int, quantity: int = 1) -> None:
+        if self.quantities[index] < quantity:
+            raise Exception(f"Impossible to use the requested quantity ({quantity}) of this tile: "
+                            f"only {self.quantities[index]} available")
+        self.quantities[index] -= quantity
+
+    def use_many(self, indices: np.ndarray) -> None:
+        """
+        Registers the usage of many tiles at once. An index can appear more than once.
+        Either all the usages are registered, or none of them.
+        :param indices: The positions of the used tiles, one for each usage
+        """
+        counts = np.bincount(np.asarray(indices, dtype=np.intp), minlength=len(self))
+        if np.any(counts > self.quantities):
+            exceeding = [self.names[i] for i in np.flatnonzero(counts > self.quantities)]
+            raise Exception(f"Impossible to use the requested quantities: not enough tiles of type {exceeding}")
+        self.quantities -= counts
+
+    def total_quantity(self) -> int:
+        return int(self.quantities.sum())
+
+
+def load_tile_image(filepath: str) -> np.ndarray:
+    """
+    Loads the image of a tile from its file, ready to be used.
+    Raw image files (".npy") are memory-mapped and used as they are, since they're expected to contain an image
+    already preprocessed. Any other file is decoded and preprocessed; the cropped image is copied, so that the pixels
+    of the margins don't stay in memory.
+    :param filepath: The path of the file
+    :return: The preprocessed image
+    """
+    if filepath.endswith(RAW_IMAGE_EXTENSION):
+        return load_raw_image(filepath)
+    return np.ascontiguousarray(Tile.preprocess_tile_image(load_image(filepath)))
+
+
+def compute_tile_coords(filepath: str, coordinator: Coordinator) -> (np.ndarray, str):
+    """
+    Loads the image of a tile and computes its coordinates.
+    This is the unit of work of the tiles ingestion: it's defined at module level so that it can be sent to the
+    processes of a pool, and it never raises, so that a bad file doesn't stop the others.
+    :param filepath: The path of the image file
+    :param coordinator: The coordinator used to compute the coordinates
+    :return: The coordinates and None if everything went fine, None and the error message otherwise
+    """
+    try:
+        return coordinator.compute(load_tile_image(filepath)), None
+    except Exception as e:
+        return None, str(e)
+
+
 class TileFactory:
 
-    def __init__(self, coordinator: Coordinator):
+    def __init__(self, coordinator: Coordinator, use_cache: bool = DEFAULT_USE_CACHE, workers: int = DEFAULT_WORKERS,
+                 image_budget: int = DEFAULT_BUDGET_BYTES):
+        """
+        Constructor.
+        :param coordinator: The coordinator used to compute the coordinates of the tiles
+        :param use_cache: Whether the coordinates of the tiles are stored in a features cache, next to the tiles
+        :param workers: The number of processes used to load the images; None uses all the available cores
+        :param image_budget: The maximum number of bytes of decoded tiles images kept in memory by the libraries
+        """
         if not coordinator:
             raise Exception("Impossible to create tiles without a system to extract coordinates")
+        if workers is not None and workers < 1:
+            raise Exception(f"Illegal number of workers: {workers}. Please use a positive value.")
         self.__coordinator = coordinator
+        self.__use_cache = use_cache
+        self.__workers = workers if workers is not None else os.cpu_count()
+        self.__image_budget = image_budget
+        self.__failures = []
+
+    @property
+    def failures(self) -> [(str, str)]:
+        """
+        The files that couldn't be loaded during the last creation, along with the reason.
+        """
+        return self.__failures
+
+    def __open_cache(self, cachepath: str) -> FeatureCache:
+        """
+        Opens a features cache.
+        The fingerprint includes everything that changes the coordinates of a tile besides its image file.
+        """
+        margins = (MARGIN_TOP, MARGIN_BOTTOM, MARGIN_LEFT, MARGIN_RIGHT)
+        fingerprint = f"margins={margins};coordinator={self.__coordinator.fingerprint()}"
+        return FeatureCache(cachepath, fingerprint)
 
-    def create_from_folder(self, tiles_folder: str) -> [Tile]:
+    def __create_tiles(self, entries: [(str, str, int)], cachepath: str) -> TileLibrary:
+        """
+        Creates the tiles from their names, image files and quantities.
+        The coordinates are taken from the cache when possible; the other images are loaded and processed, in parallel
+        if more than one worker is available. The tiles are returned in the same order of the entries.
+        Files that can't be loaded are reported and skipped.
+        :param entries: The name, the image path and the quantity of each tile
+        :param cachepath: The path of the features cache
+        :return: The library of the tiles
+        """
+        self.__failures = []
+        cache = self.__open_cache(cachepath) if self.__use_cache else None
+
+        # Looking for the coordinates in the cache
+        coords_list = [None] * len(entries)
+        errors = [None] * len(entries)
+        if cache:
+            for (i, (_, filepath, _)) in enumerate(entries):
+                try:
+                    coords_list[i] = cache.get(filepath)
+                except OSError as e:
+                    errors[i] = str(e)
+        missing = [i for i in range(len(entries)) if coords_list[i] is None and errors[i] is None]
+
+        # Computing the missing coordinates
+        missing_paths = [entries[i][1] for i in missing]
+        if self.__workers > 1 and len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.__workers, len(missing))) as executor:
+                results = list(executor.map(compute_tile_coords, missing_paths, repeat(self.__coordinator)))
+        else:
+            results = [compute_tile_coords(filepath, self.__coordinator) for filepath in missing_paths]
+        INSTRUMENTATION.count("tiles_cache_hits", len(entries) - len(missing))
+        INSTRUMENTATION.count("tiles_decoded", len(missing))
+        for (i, (coords, error)) in zip(missing, results):
+            coords_list[i] = coords
+            errors[i] = error
+            if coords is not None and cache:
+                cache.put(entries[i][1], coords)
+
+        # Creating the library; the images will be loaded only if they're needed
+        loaded = []
+        for ((name, filepath, quantity), coords, error) in zip(entries, coords_list, errors):
+            if error is not None:
+                print(f'Skipping tile "{name}": cannot load <{filepath}> ({error})')
+                self.__failures.append((filepath, error))
+                continue
+            loaded.append((name, filepath, quantity, coords))
+
+        if cache:
+            cache.save()
+        store = ImageStore(load_tile_image, budget_bytes=self.__image_budget)
+        if not loaded:
+            return TileLibrary([], np.empty(shape=(0, 0)), [], [], store=store)
+        (names, filepaths, quantities, coords) = zip(*loaded)
+        return TileLibrary(names, np.stack(coords), quantities, filepaths, store=store)
+
+    def create_from_folder(self, tiles_folder: str) -> TileLibrary:
         """
         Creates a tiles list from a folder. In the folder this method expects to find the images of the tiles.
         Every image file (with ".png" or ".jpg" extension!) is used as a tile.
         The name of the tile will be the name of the file. The default quantity is set to 1.
 
         :param tiles_folder: The name of the folder where the tiles images are
-        :return: The tiles array
+        :return: The library of the tiles, which can be used as a list of tiles
         """
-        tiles_list = []
-        directory = os.fsencode(tiles_folder)
-        for file in os.listdir(directory):
-            filename = os.fsdecode(file)
+        entries = []
+        for filename in sorted(os.listdir(tiles_folder)):
             if filename.endswith(".png") or filename.endswith(".jpg"):
                 print(f"Found tile image <{filename}>")
                 # Extracting the name by cutting the file extension
                 tilename = os.path.splitext(filename)[0]
-                # Opening the image from the tiles folder, as a np array
-                img = load_image(filename)
-                # Creating the tile
-                tiles_list.append(Tile(name=tilename, img=img, coordinator=self.__coordinator))
-        return tiles_list
+                entries.append((tilename, os.path.join(tiles_folder, filename), 1))
+        cachepath = os.path.join(tiles_folder, FOLDER_CACHE_NAME + CACHE_FILE_SUFFIX)
+        with INSTRUMENTATION.stage("tile_ingestion"):
+            return self.__create_tiles(entries, cachepath)
 
-    def create_from_file(self, tiles_info: str, tiles_folder: str = "") -> [Tile]:
+    def create_from_file(self, tiles_info: str, tiles_folder: str = "") -> TileLibrary:
         """
         Creates a tiles list from a specific CSV file indicating:
         - The identification name for each tile     (Column name: name)
@@ -128,42 +417,39 @@ class TileFactory:
 
         :param tiles_info: The CSV file guiding the creation of the tiles
         :param tiles_folder: An optional folder path where the images are stored
-        :return: The tiles array
+        :return: The library of the tiles, which can be used as a list of tiles
         """
         # Handling tiles_folder parameter
         if not tiles_folder:
             # Assuming the reference folder is the current one OR the whole path is contined in the csv
             tiles_folder = ""
         # Eventually adding the "/" to the name
-        if not tiles_folder.endswith("/"):
+        elif not tiles_folder.endswith("/"):
             tiles_folder += "/"
 
-        # Init tiles list
-        tiles_list = []
-
         # Checking csv file
         if not tiles_info.endswith(".csv"):
             raise Exception("The information file is not in CSV format. A CSV file is required")
 
         # Reading CSV file
+        entries = []
         with open(tiles_info, mode='r') as csv_file:
             csv_reader = csv.DictReader(csv_file)
-            next(csv_reader)
             for row in csv_reader:
                 filename = row[CSV_COL_FILENAME]
                 quantity = int(row[CSV_COL_QUANTITY])
                 print(f'Tile "{row[CSV_COL_NAME]}", file: <{filename}>, quantity: {quantity}')
-                # Opening the image from the tiles folder, as a np array
-                img = load_image(tiles_folder + filename)
-                # Creating the tile
-                tile = Tile(name=row[CSV_COL_NAME], img=img, coordinator=self.__coordinator, quantity=quantity)
-                tiles_list.append(tile)
+                entries.append((row[CSV_COL_NAME], tiles_folder + filename, quantity))
 
+        with INSTRUMENTATION.stage("tile_ingestion"):
+            tiles_list = self.__create_tiles(entries, os.path.splitext(tiles_info)[0] + CACHE_FILE_SUFFIX)
         print(f"{len(tiles_list)} tiles correctly created")
         return tiles_list
 
     @classmethod
     def count_quantity(cls, tiles_list: [Tile]):
+        if isinstance(tiles_list, TileLibrary):
+            return tiles_list.total_quantity()
         count: int = 0
         for t in tiles_list:
             count += t.quantity
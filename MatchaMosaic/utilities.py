@@ -1,12 +1,18 @@
-from matplotlib import pyplot as plt
+import os
+
 import cv2
 
+TARGET_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
 
 def show_image(img) -> None:
     """
     Showing the image.
+    Matplotlib is imported here, so that it's loaded only when an image is actually shown: the headless usages don't
+    pay for its import, nor need a display.
     :param img: The image to show
     """
+    from matplotlib import pyplot as plt
     plt.imshow(img, interpolation='nearest')
     plt.show()
 
@@ -18,5 +24,44 @@ def load_image(filepath: str):
     :return: An image, as a numpy array
     """
     img = cv2.imread(filepath)
+    if img is None:
+        raise Exception(f"Impossible to load the image <{filepath}>")
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     return img
+
+
+def save_image(filepath: str, img) -> None:
+    """
+    Saving an image to file; the format is chosen by the extension.
+    :param filepath: The path of the file image
+    :param img: The RGB image, as a numpy array
+    """
+    # The images of the pipeline are RGB, while OpenCV writes BGR
+    if not cv2.imwrite(filepath, cv2.cvtColor(img, cv2.COLOR_RGB2BGR)):
+        raise Exception(f"Impossible to write the image <{filepath}>")
+
+
+def parse_grid(text: str) -> (int, int):
+    """
+    Parsing the size of a grid written as rows and columns, e.g. "42x57".
+    :param text: The size of the grid
+    :return: The number of rows and columns
+    """
+    (rows, cols) = text.lower().split("x")
+    return int(rows), int(cols)
+
+
+def list_targets(paths: [str]) -> [str]:
+    """
+    Expands a list of target paths: folders are replaced by the images they contain, in alphabetical order.
+    :param paths: The paths of images or folders
+    :return: The paths of the images
+    """
+    targets = []
+    for path in paths:
+        if os.path.isdir(path):
+            targets += sorted(os.path.join(path, name) for name in os.listdir(path)
+                              if name.lower().endswith(TARGET_EXTENSIONS))
+        else:
+            targets.append(path)
+    return targets